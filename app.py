@@ -1,17 +1,39 @@
 # app.py
+import hashlib
+import hmac
+import io
+import json
+import math
 import os
-from datetime import datetime, date
+import re
+import secrets
+import select
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, date, timedelta
+import click
+import numpy as np
 import requests
 import qrcode
+import qrcode.image.svg
+from requests.adapters import HTTPAdapter
+from PIL import Image, ImageOps
 
 from flask import (
     Flask, render_template, request, redirect,
-    session, url_for, flash, abort
+    session, url_for, flash, abort, jsonify, send_file, g
 )
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask_socketio import SocketIO, join_room
+from flask_socketio import SocketIO, join_room, emit
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -40,6 +62,74 @@ os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
 ALLOWED_IMAGE_EXT = {"png", "jpg", "jpeg", "gif", "webp"}
 ALLOWED_VIDEO_EXT = {"mp4", "webm", "ogg"}
 
+# gambar upload di-encode ulang ke WebP per lebar ini (px, untuk srcset); tidak pernah diperbesar
+app.config["IMAGE_VARIANT_WIDTHS"] = tuple(
+    int(w) for w in os.getenv("IMAGE_VARIANT_WIDTHS", "480,960,1920").split(",") if w.strip()
+)
+app.config["IMAGE_WEBP_QUALITY"] = int(os.getenv("IMAGE_WEBP_QUALITY", "80"))
+
+# upload video bertahap (per potongan, bisa dilanjutkan); file setengah jadi di luar folder static
+app.config["CHUNK_UPLOAD_FOLDER"] = os.getenv("CHUNK_UPLOAD_FOLDER", os.path.join("instance", "chunk_uploads"))
+app.config["CHUNK_UPLOAD_CHUNK_BYTES"] = int(os.getenv("CHUNK_UPLOAD_CHUNK_BYTES", str(4 * 1024 * 1024)))
+app.config["CHUNK_UPLOAD_TTL_HOURS"] = int(os.getenv("CHUNK_UPLOAD_TTL_HOURS", "24"))
+app.config["VIDEO_UPLOAD_MAX_BYTES"] = int(os.getenv("VIDEO_UPLOAD_MAX_BYTES", str(500 * 1024 * 1024)))
+
+# media display disajikan lewat /media/<hash isi>/<path> (lihat media_url)
+app.config["MEDIA_DIGEST_CACHE_SIZE"] = int(os.getenv("MEDIA_DIGEST_CACHE_SIZE", "2000"))
+# QR code dirender di memori (/qr/<slug>.png|svg), hasilnya di-cache per proses
+app.config["QR_CACHE_SIZE"] = int(os.getenv("QR_CACHE_SIZE", "500"))
+# URL publik aplikasi (misal https://antrifast.id) untuk isi QR code; jangan dari header Host request
+app.config["PUBLIC_BASE_URL"] = os.getenv("PUBLIC_BASE_URL", "")
+# 1 = serahkan pengiriman file ke nginx/apache lewat header X-Sendfile
+app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE", "0") == "1"
+
+# jumlah maksimal UMKM yang snapshot antriannya disimpan di memori (per proses)
+app.config["QUEUE_SNAPSHOT_CACHE_SIZE"] = int(os.getenv("QUEUE_SNAPSHOT_CACHE_SIZE", "500"))
+# baris UMKM (read-only) untuk route dashboard yang hanya butuh id/slug/nama (lihat get_cached_umkm)
+app.config["UMKM_CACHE_SIZE"] = int(os.getenv("UMKM_CACHE_SIZE", "1000"))
+app.config["UMKM_CACHE_TTL_SECONDS"] = float(os.getenv("UMKM_CACHE_TTL_SECONDS", "30"))
+
+# estimasi waktu tunggu (ETA): rata-rata bergerak eksponensial durasi layanan per UMKM
+app.config["ETA_EWMA_ALPHA"] = float(os.getenv("ETA_EWMA_ALPHA", "0.2"))
+# durasi layanan di atas batas ini (misal kasir lupa menekan tombol) dipotong
+app.config["ETA_MAX_SAMPLE_MINUTES"] = int(os.getenv("ETA_MAX_SAMPLE_MINUTES", "60"))
+# nilai awal diambil dari rollup statistik N hari terakhir
+app.config["ETA_SEED_DAYS"] = int(os.getenv("ETA_SEED_DAYS", "14"))
+
+# gateway WA & worker outbox (lihat bagian WA OUTBOX)
+app.config["WA_API_URL"] = os.getenv("WA_API_URL", "https://wa.sukipli.work/send-message")
+app.config["WA_HTTP_POOL_SIZE"] = int(os.getenv("WA_HTTP_POOL_SIZE", "10"))
+app.config["WA_CONNECT_TIMEOUT"] = float(os.getenv("WA_CONNECT_TIMEOUT", "3"))
+app.config["WA_READ_TIMEOUT"] = float(os.getenv("WA_READ_TIMEOUT", "10"))
+# circuit breaker: setelah N kegagalan beruntun, tolak cepat selama cooldown
+app.config["WA_BREAKER_THRESHOLD"] = int(os.getenv("WA_BREAKER_THRESHOLD", "5"))
+app.config["WA_BREAKER_COOLDOWN_SECONDS"] = float(os.getenv("WA_BREAKER_COOLDOWN_SECONDS", "30"))
+app.config["WA_OUTBOX_WORKERS"] = int(os.getenv("WA_OUTBOX_WORKERS", "4"))
+app.config["WA_OUTBOX_MAX_ATTEMPTS"] = int(os.getenv("WA_OUTBOX_MAX_ATTEMPTS", "5"))
+app.config["WA_OUTBOX_RETRY_BASE_SECONDS"] = int(os.getenv("WA_OUTBOX_RETRY_BASE_SECONDS", "15"))
+app.config["WA_OUTBOX_LEASE_SECONDS"] = int(os.getenv("WA_OUTBOX_LEASE_SECONDS", "120"))
+app.config["WA_OUTBOX_POLL_SECONDS"] = float(os.getenv("WA_OUTBOX_POLL_SECONDS", "5"))
+# 0 = jangan jalankan worker di proses web (misal pakai `flask wa-worker` terpisah)
+app.config["WA_OUTBOX_AUTOSTART"] = os.getenv("WA_OUTBOX_AUTOSTART", "1") == "1"
+# wa_logs: respons gateway dipotong ke N karakter; `flask purge-wa-logs` mengosongkan isi pesan &
+# respons log yang lebih tua dari BODY_DAYS (sekaligus menghapus baris wa_outbox yang sudah selesai
+# dari periode itu), dan menghapus log yang lebih tua dari DAYS (0 = simpan)
+app.config["WA_LOG_RESPONSE_MAX_CHARS"] = int(os.getenv("WA_LOG_RESPONSE_MAX_CHARS", "500"))
+app.config["WA_LOG_BODY_RETENTION_DAYS"] = int(os.getenv("WA_LOG_BODY_RETENTION_DAYS", "30"))
+app.config["WA_LOG_RETENTION_DAYS"] = int(os.getenv("WA_LOG_RETENTION_DAYS", "365"))
+# /admin/metrics hanya bisa dibuka dengan header "Authorization: Bearer <token>"; kosong = endpoint mati
+app.config["ADMIN_METRICS_TOKEN"] = os.getenv("ADMIN_METRICS_TOKEN", "")
+
+# jendela penggabungan broadcast per room (ms); 0 = kirim langsung
+app.config["BROADCAST_COALESCE_MS"] = int(os.getenv("BROADCAST_COALESCE_MS", "150"))
+# GET /api/<slug>/state?wait=N: batas long-polling (detik) & interval cek ulang versi di DB
+# (jaga-jaga perubahan dari worker lain yang notifikasinya tidak sampai ke proses ini)
+app.config["API_STATE_MAX_WAIT_SECONDS"] = float(os.getenv("API_STATE_MAX_WAIT_SECONDS", "30"))
+app.config["API_STATE_POLL_SECONDS"] = float(os.getenv("API_STATE_POLL_SECONDS", "5"))
+# "local" = emit hanya ke client di proses ini (1 worker)
+# "postgres" = fan-out ke semua worker lewat LISTEN/NOTIFY (lihat PostgresFanout)
+app.config["SOCKETIO_BACKEND"] = os.getenv("SOCKETIO_BACKEND", "local")
+
 socketio = SocketIO(app)
 
 # --------------------------------------------------
@@ -52,6 +142,12 @@ def inject_now():
     return {"now": datetime.now}
 
 
+@app.context_processor
+def inject_media_helpers():
+    # {{ media_url(path) }} untuk file upload, {{ image_srcset(path) }} untuk gambar hasil encode_webp_variants
+    return {"media_url": media_url, "image_srcset": image_srcset}
+
+
 # --------------------------------------------------
 # MODELS
 # --------------------------------------------------
@@ -76,11 +172,16 @@ class UMKM(db.Model):
     name = db.Column(db.String(150))
     owner_whatsapp = db.Column(db.String(30), nullable=True)
     slug = db.Column(db.String(150), unique=True)
-    credit_balance = db.Column(db.Integer, default=0)
+    credit_balance = db.Column(db.Integer, default=0)  # kredit bebas (belum dipesan)
+    # kredit yang sedang dipesan pesan WA berbayar di outbox (lihat credit_reserve)
+    credit_reserved = db.Column(db.Integer, nullable=False, default=0)
+    # kolom lama, tidak dipakai lagi: QR selalu dirender di /qr/<slug>.<fmt> (lihat qr_image)
     qr_path = db.Column(db.String(255), nullable=True)
     display_ticker = db.Column(db.Text, nullable=True)
-    display_images = db.Column(db.Text, nullable=True)
-    display_videos = db.Column(db.Text, nullable=True)
+    # gambar/video display ada di tabel display_media (kolom lama display_images/display_videos
+    # hanya dibaca sekali oleh upgrade_schema)
+    # naik 1 setiap ada perubahan antrian (lihat bump_queue_version)
+    queue_version = db.Column(db.Integer, nullable=False, default=0)
     created_at = db.Column(db.DateTime, default=datetime.now)
 
     queues = db.relationship("Queue", backref="umkm", lazy=True)
@@ -97,279 +198,2116 @@ class Queue(db.Model):
     customer_name = db.Column(db.String(120))
     customer_phone = db.Column(db.String(30))
     status = db.Column(db.String(20), default="waiting")  # waiting/called/done/canceled
+    # hari layanan, disimpan terpisah dari created_at supaya filter per hari bisa pakai index
+    service_date = db.Column(db.Date, default=date.today)
     created_at = db.Column(db.DateTime, default=datetime.now)
     called_at = db.Column(db.DateTime)
     finished_at = db.Column(db.DateTime)
     canceled_at = db.Column(db.DateTime)
 
-    wa_logs = db.relationship("WALog", backref="queue", lazy=True)
+    # wa_logs.queue_id sengaja tanpa foreign key: log tetap menunjuk id tiket setelah tiketnya
+    # dipindah ke queues_archive (lihat archive_queues)
+    wa_logs = db.relationship(
+        "WALog",
+        primaryjoin="foreign(WALog.queue_id) == Queue.id",
+        backref="queue",
+        lazy=True
+    )
+
+    __table_args__ = (
+        db.Index("ix_queues_umkm_day_status_number", "umkm_id", "service_date", "status", "queue_number"),
+        # tanpa AUTOINCREMENT SQLite memakai ulang id setelah tabel dikosongkan archive_queues,
+        # lalu bentrok dengan id di queues_archive (Postgres: sequence memang tidak pernah mundur)
+        {"sqlite_autoincrement": True},
+    )
+
+
+class QueueArchive(db.Model):
+    """
+    Tiket hari-hari sebelumnya, dipindah dari tabel queues oleh `flask archive-queues` (malam hari),
+    supaya tabel queues hanya berisi antrian hari ini. Kolom & id sama persis dengan queues.
+    Statistik membaca gabungan keduanya lewat queue_history.
+    """
+    __tablename__ = "queues_archive"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    umkm_id = db.Column(db.Integer, db.ForeignKey("umkm.id"))
+    queue_number = db.Column(db.Integer)
+    customer_name = db.Column(db.String(120))
+    customer_phone = db.Column(db.String(30))
+    status = db.Column(db.String(20))
+    service_date = db.Column(db.Date)
+    created_at = db.Column(db.DateTime)
+    called_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    canceled_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index("ix_queues_archive_umkm_day", "umkm_id", "service_date"),
+    )
+
+
+class QueueCounter(db.Model):
+    """Nomor antrian terakhir per UMKM per hari layanan (dipakai allocate_queue_number)."""
+    __tablename__ = "queue_counters"
+
+    umkm_id = db.Column(db.Integer, db.ForeignKey("umkm.id"), primary_key=True)
+    service_date = db.Column(db.Date, primary_key=True)
+    last_number = db.Column(db.Integer, nullable=False, default=0)
+
+
+class QueueStatsHourly(db.Model):
+    """
+    Rollup statistik antrian per UMKM per jam (jam = jam tiket diambil), diperbarui setiap tiket
+    berubah status (lihat record_ticket_stats). Bisa dibangun ulang: flask rebuild-stats.
+    """
+    __tablename__ = "queue_stats_hourly"
+
+    umkm_id = db.Column(db.Integer, db.ForeignKey("umkm.id"), primary_key=True)
+    hour = db.Column(db.DateTime, primary_key=True)
+    issued = db.Column(db.Integer, nullable=False, default=0)
+    served = db.Column(db.Integer, nullable=False, default=0)
+    no_show = db.Column(db.Integer, nullable=False, default=0)
+    canceled = db.Column(db.Integer, nullable=False, default=0)
+    # total detik menunggu (ambil → dipanggil) & dilayani (dipanggil → selesai), hanya tiket served
+    sum_wait = db.Column(db.Float, nullable=False, default=0)
+    sum_service = db.Column(db.Float, nullable=False, default=0)
+
+
+class WALog(db.Model):
+    """
+    Log hasil kirim WA. Setelah WA_LOG_BODY_RETENTION_DAYS, message & response_raw dikosongkan
+    (flask purge-wa-logs) sehingga yang tersisa hanya ringkasan untuk audit: UMKM, tiket, jenis,
+    status & waktu.
+    """
+    __tablename__ = "wa_logs"
+
+    id = db.Column(db.Integer, primary_key=True)
+    umkm_id = db.Column(db.Integer, db.ForeignKey("umkm.id"))
+    queue_id = db.Column(db.Integer)  # id tiket di queues atau queues_archive
+    phone_number = db.Column(db.String(30))
+    message = db.Column(db.Text)
+    message_kind = db.Column(db.String(20))  # NEW_TICKET / AUTO_REMINDER / MANUAL / TOPUP
+    status = db.Column(db.String(20))  # 200/error/...
+    response_raw = db.Column(db.Text)  # dipotong ke WA_LOG_RESPONSE_MAX_CHARS
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    __table_args__ = (
+        db.Index("ix_wa_logs_queue_kind", "queue_id", "message_kind"),
+        db.Index("ix_wa_logs_umkm_created", "umkm_id", "created_at"),
+        db.Index("ix_wa_logs_created", "created_at"),
+    )
+
+
+class WAOutbox(db.Model):
+    """
+    Pesan WA yang menunggu dikirim worker background (lihat WAOutboxDispatcher).
+    Baris sent/failed dihapus setelah WA_LOG_BODY_RETENTION_DAYS (flask purge-wa-logs).
+    """
+    __tablename__ = "wa_outbox"
+
+    id = db.Column(db.Integer, primary_key=True)
+    umkm_id = db.Column(db.Integer, db.ForeignKey("umkm.id"))
+    queue_id = db.Column(db.Integer, index=True)
+    phone_number = db.Column(db.String(30), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    kind = db.Column(db.String(20))  # NEW_TICKET / AUTO_REMINDER / MANUAL / TOPUP
+    # 1 kredit UMKM sudah dipesan saat enqueue; jadi terpakai kalau terkirim, kembali kalau gagal
+    charge_credit = db.Column(db.Boolean, nullable=False, default=False)
+    credit_description = db.Column(db.String(255))
+    status = db.Column(db.String(20), nullable=False, default="pending")  # pending/sending/sent/failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index("ix_wa_outbox_status_next", "status", "next_attempt_at"),
+        # retensi: baris sent/failed lama dihapus oleh purge_wa_logs
+        db.Index("ix_wa_outbox_status_created", "status", "created_at"),
+    )
+
+
+class DisplayMedia(db.Model):
+    """Satu gambar/video di playlist display kiosk, diputar urut berdasarkan position."""
+    __tablename__ = "display_media"
+
+    id = db.Column(db.Integer, primary_key=True)
+    umkm_id = db.Column(db.Integer, db.ForeignKey("umkm.id"), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)  # image / video
+    path = db.Column(db.String(255), nullable=False, index=True)  # relatif ke static, misal upload/slug/x.mp4
+    # urutan tayang, diberi jarak DISPLAY_MEDIA_GAP supaya geser urutan cukup ubah 1 baris
+    position = db.Column(db.Integer, nullable=False, default=0)
+    size = db.Column(db.BigInteger)  # byte
+    hash = db.Column(db.String(64))  # sha256 isi file
+    duration = db.Column(db.Float)  # detik tayang gambar (None = default kiosk); video diputar sampai selesai
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    __table_args__ = (
+        db.Index("ix_display_media_umkm_position", "umkm_id", "position"),
+    )
+
+
+class CreditLog(db.Model):
+    __tablename__ = "credit_logs"
+
+    id = db.Column(db.Integer, primary_key=True)
+    umkm_id = db.Column(db.Integer, db.ForeignKey("umkm.id"))
+    change = db.Column(db.Integer)  # + / -
+    description = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+class TopupTransaction(db.Model):
+    __tablename__ = "topup_transactions"
+
+    id = db.Column(db.Integer, primary_key=True)
+    umkm_id = db.Column(db.Integer, db.ForeignKey("umkm.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+
+    package_name = db.Column(db.String(100), nullable=False)
+    credits = db.Column(db.Integer, nullable=False)
+    amount = db.Column(db.Integer, nullable=True)  # nominal rupiah (opsional)
+
+    # gambar QRIS yang digunakan (misal: img/qris_kecil.png)
+    qris_image = db.Column(db.String(255), nullable=True)
+    # path bukti transfer (gambar) yang diupload user
+    proof_image = db.Column(db.String(255), nullable=True)
+
+    # "pending"        = baru pilih paket, belum konfirmasi
+    # "waiting_admin"  = user sudah konfirmasi + upload bukti, menunggu ACC admin
+    # "success"        = admin sudah ACC, kredit sudah masuk
+    # "rejected"       = admin tolak (opsional)
+    status = db.Column(db.String(20), default="pending")
+
+    sender_name = db.Column(db.String(150), nullable=True)
+    note = db.Column(db.String(255), nullable=True)
+
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    confirmed_at = db.Column(db.DateTime, nullable=True)
+
+    umkm = db.relationship("UMKM", backref="topup_transactions", lazy=True)
+    user = db.relationship("User", backref="topup_transactions", lazy=True)
+
+    __table_args__ = (
+        # daftar admin: filter status, urut terbaru (keyset pagination, lihat admin_topup_list)
+        db.Index("ix_topup_status_created", "status", "created_at", "id"),
+        db.Index("ix_topup_created", "created_at", "id"),
+    )
+
+# --------------------------------------------------
+# CACHE: SNAPSHOT ANTRIAN LIVE PER UMKM
+# --------------------------------------------------
+
+class LRUCache:
+    """Dict thread-safe dengan ukuran maksimal; entry yang paling lama tidak dipakai dibuang."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            return self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+# satu baris antrian di snapshot (immutable, aman dibagi antar request)
+QueueEntry = namedtuple(
+    "QueueEntry",
+    ["id", "queue_number", "customer_name", "customer_phone", "status", "called_at", "service_date"]
+)
+
+queue_snapshot_cache = LRUCache(app.config["QUEUE_SNAPSHOT_CACHE_SIZE"])
+
+
+def bump_queue_version(umkm_id: int) -> int:
+    """
+    Naikkan umkm.queue_version secara atomik di transaksi yang sedang berjalan.
+    Dipanggil oleh setiap route yang mengubah antrian, SEBELUM commit.
+    Karena versi disimpan di DB, snapshot di worker lain otomatis dianggap basi.
+    Versi yang dikembalikan dipakai untuk broadcast_queue_delta setelah commit.
+    """
+    return db.session.execute(
+        db.update(UMKM)
+        .where(UMKM.id == umkm_id)
+        .values(queue_version=UMKM.queue_version + 1)
+        .returning(UMKM.queue_version)
+    ).scalar_one()
+
+
+def queue_entry(q: Queue) -> QueueEntry:
+    return QueueEntry(
+        q.id, q.queue_number, q.customer_name, q.customer_phone, q.status, q.called_at, q.service_date
+    )
+
+
+def is_open_today(q: Queue) -> bool:
+    """Tiket masih berjalan (waiting/called) dan milik antrian hari ini."""
+    return q.status in ("waiting", "called") and q.service_date == date.today()
+
+
+def apply_queue_ops(snapshot: dict, version: int, ops: list) -> dict:
+    """
+    Snapshot baru hasil menerapkan ops (lihat broadcast_queue_delta) ke snapshot lama.
+    Tiket dari hari lain diabaikan; tiket yang sudah ada di histori diganti, tidak dobel.
+    """
+    current_called = snapshot["current_called"]
+    waiting = list(snapshot["waiting"])
+    history = list(snapshot["history"])
+    count_today = snapshot["count_today"]
+
+    for op, entry in ops:
+        if entry.service_date != snapshot["service_date"]:
+            continue
+        waiting = [e for e in waiting if e.id != entry.id]
+        if op == "added":
+            waiting.append(entry)
+            count_today += 1
+        elif op == "called":
+            current_called = entry
+        elif op == "removed":
+            if current_called and current_called.id == entry.id:
+                current_called = None
+            history = [e for e in history if e.id != entry.id]
+            history.append(entry)
+
+    return dict(
+        snapshot,
+        version=version,
+        current_called=current_called,
+        waiting=tuple(sorted(waiting, key=lambda e: e.queue_number)),
+        history=tuple(sorted(history, key=lambda e: e.queue_number)),
+        count_today=count_today
+    )
+
+
+def update_cached_snapshot(umkm_id: int, version: int, ops: list):
+    """
+    Write-through: kalau snapshot di memori tepat satu versi di belakang, terapkan ops;
+    kalau tidak (tidak ada / basi / beda hari), buang saja dan biarkan dibangun ulang.
+    """
+    snapshot = queue_snapshot_cache.get(umkm_id)
+    if (snapshot and snapshot["version"] == version - 1
+            and snapshot["service_date"] == date.today()):
+        queue_snapshot_cache.set(umkm_id, apply_queue_ops(snapshot, version, ops))
+    else:
+        queue_snapshot_cache.pop(umkm_id)
+
+
+def build_queue_snapshot(umkm_id: int, version: int, day: date) -> dict:
+    """
+    Satu query untuk semua tiket UMKM pada hari itu, lalu dipisah per status di Python:
+    nomor yang sedang dipanggil, daftar waiting, histori & total tiket hari ini.
+    """
+    rows = (
+        db.session.query(
+            Queue.id, Queue.queue_number, Queue.customer_name,
+            Queue.customer_phone, Queue.status, Queue.called_at, Queue.service_date
+        )
+        .filter(
+            Queue.umkm_id == umkm_id,
+            Queue.service_date == day
+        )
+        .order_by(Queue.queue_number.asc())
+        .all()
+    )
+    entries = [QueueEntry(*row) for row in rows]
+    seed_service_estimate(umkm_id)
+
+    waiting = tuple(e for e in entries if e.status == "waiting")
+    history = tuple(e for e in entries if e.status in ("done", "canceled", "no_show"))
+    called = [e for e in entries if e.status == "called"]
+    # kalau ada lebih dari satu "called", yang terakhir dipanggil yang tampil
+    current_called = max(called, key=lambda e: e.called_at or datetime.min) if called else None
+
+    return {
+        "umkm_id": umkm_id,
+        "version": version,
+        "service_date": day,
+        "current_called": current_called,
+        "waiting": waiting,
+        "history": history,
+        "count_today": len(entries),
+    }
+
+
+def get_queue_snapshot(umkm: UMKM) -> dict:
+    """
+    Snapshot antrian hari ini untuk UMKM, dari memori kalau versinya masih sama
+    dengan umkm.queue_version (baris UMKM toh sudah di-load oleh route pemanggil).
+    """
+    today = date.today()
+    version = umkm.queue_version or 0
+
+    snapshot = queue_snapshot_cache.get(umkm.id)
+    if snapshot and snapshot["version"] == version and snapshot["service_date"] == today:
+        return snapshot
+
+    snapshot = build_queue_snapshot(umkm.id, version, today)
+    queue_snapshot_cache.set(umkm.id, snapshot)
+    return snapshot
+
+
+def queue_snapshot_payload(snapshot: dict) -> dict:
+    """
+    Format snapshot untuk event socket queue_update.
+    - service_seconds: rata-rata durasi layanan (EWMA), None kalau belum ada data
+    - current_called.elapsed_seconds: sudah berapa lama nomor itu dipanggil
+    - waiting[].eta_minutes: perkiraan menit sampai dipanggil (lihat waiting_eta_seconds)
+    """
+    current = snapshot["current_called"]
+    etas = waiting_eta_seconds(snapshot)
+    return {
+        "version": snapshot["version"],
+        "count_today": snapshot["count_today"],
+        "service_seconds": service_estimator.get(snapshot["umkm_id"]),
+        "current_called": {
+            "number": current.queue_number,
+            "name": current.customer_name or "Tanpa nama",
+            "elapsed_seconds": int((datetime.now() - current.called_at).total_seconds()) if current.called_at else 0
+        } if current else None,
+        "waiting": [
+            {
+                "number": q.queue_number,
+                "name": q.customer_name or "Tanpa nama",
+                "eta_minutes": eta_minutes(eta)
+            } for q, eta in zip(snapshot["waiting"], etas)
+        ]
+    }
+
+
+# --------------------------------------------------
+# UTIL: AUTH, QUEUE, WA, QR
+# --------------------------------------------------
+
+def allowed_file(filename, allowed_ext):
+    return "." in filename and filename.rsplit(".", 1)[1].lower() in allowed_ext
+
+class RoomBroadcaster:
+    """
+    Menggabungkan broadcast antrian per room (slug) dalam jendela BROADCAST_COALESCE_MS.
+    - Delta yang versinya bersambung digabung jadi satu pesan (base_version pertama → version terakhir).
+    - Delta yang tidak bersambung (ada perubahan dari worker lain) membuat room ditandai "full":
+      saat flush snapshot terbaru dihitung & dikirim SEKALI.
+    Flush berjalan lewat socketio.start_background_task/socketio.sleep, jadi ikut async mode
+    yang dipakai (eventlet di production, thread biasa di lokal).
+    """
+
+    def __init__(self, flask_app, sio):
+        self.app = flask_app
+        self.sio = sio
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.counters = {"requested": 0, "emitted": 0, "saved": 0}
+
+    def publish_delta(self, umkm: UMKM, version: int, ops: list, service_seconds=None):
+        self._publish(umkm, {"base_version": version - 1, "version": version, "ops": ops,
+                             "service_seconds": service_seconds, "full": False})
+
+    def _publish(self, umkm: UMKM, item: dict):
+        window = self.app.config["BROADCAST_COALESCE_MS"] / 1000.0
+        room = umkm.slug
+
+        with self._lock:
+            self.counters["requested"] += 1
+            pending = self._pending.get(room)
+            if pending:
+                self.counters["saved"] += 1
+                if pending["full"] or pending["version"] != item["base_version"]:
+                    pending["full"] = True
+                else:
+                    pending["ops"].extend(item["ops"])
+                    pending["version"] = item["version"]
+                    pending["service_seconds"] = item["service_seconds"]
+                return
+
+            item["umkm_id"] = umkm.id
+            if window > 0:
+                self._pending[room] = item
+                self.sio.start_background_task(self._flush_later, room, window)
+                return
+
+        self._emit(room, item)
+
+    def _flush_later(self, room: str, window: float):
+        self.sio.sleep(window)
+        with self._lock:
+            item = self._pending.pop(room, None)
+        if item:
+            self._emit(room, item)
+
+    def _emit(self, room: str, item: dict):
+        with self._lock:
+            self.counters["emitted"] += 1
+
+        if self.app.config["SOCKETIO_BACKEND"] == "postgres":
+            try:
+                if item["full"]:
+                    # worker penerima mengirim snapshot dari cache-nya sendiri
+                    pg_fanout.publish(room, item["umkm_id"], "refresh", {})
+                else:
+                    pg_fanout.publish(room, item["umkm_id"], "queue_delta", {
+                        "base_version": item["base_version"],
+                        "version": item["version"],
+                        "ops": item["ops"],
+                        "service_seconds": item["service_seconds"]
+                    })
+                return
+            except Exception as e:
+                # NOTIFY gagal: minimal client di worker ini tetap dapat update
+                print("Error pg_notify:", e)
+
+        if not item["full"]:
+            self.sio.emit("queue_delta", {
+                "base_version": item["base_version"],
+                "version": item["version"],
+                "ops": item["ops"],
+                "service_seconds": item["service_seconds"]
+            }, room=room)
+            return
+
+        with self.app.app_context():
+            umkm = db.session.get(UMKM, item["umkm_id"])
+            if umkm:
+                self.sio.emit("queue_update", queue_snapshot_payload(get_queue_snapshot(umkm)), room=room)
+
+
+queue_broadcaster = RoomBroadcaster(app, socketio)
+
+
+class PostgresFanout:
+    """
+    Broadcast antar proses (beberapa worker gunicorn) lewat Postgres LISTEN/NOTIFY, tanpa Redis.
+    - publish: pg_notify ke channel per UMKM (antrifast_umkm_<id>) dengan payload JSON kecil.
+    - Tiap worker punya satu koneksi LISTEN (background task) untuk channel UMKM yang punya
+      client di worker itu, lalu meneruskan pesannya ke room lokal.
+    - Payload yang melebihi batas NOTIFY dikirim sebagai "refresh": worker penerima
+      mengirim snapshot dari cache-nya sendiri.
+    - Setelah koneksi LISTEN tersambung ulang, semua room lokal di-refresh (notifikasi
+      selama terputus hilang).
+    """
+
+    MAX_PAYLOAD_BYTES = 7500  # batas NOTIFY Postgres 8000 byte
+
+    def __init__(self, flask_app, sio):
+        self.app = flask_app
+        self.sio = sio
+        self.pid = None
+        self._channels = {}  # channel -> room (slug)
+        self._lock = threading.Lock()
+        self._wake_r = self._wake_w = None
+
+    @staticmethod
+    def channel_for(umkm_id: int) -> str:
+        return f"antrifast_umkm_{int(umkm_id)}"
+
+    def start(self):
+        with self._lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self._wake_r, self._wake_w = os.pipe()
+        self.sio.start_background_task(self.run_forever)
+
+    def subscribe(self, umkm_id: int, room: str):
+        """Pastikan worker ini LISTEN ke channel UMKM (dipanggil saat client join room)."""
+        channel = self.channel_for(umkm_id)
+        with self._lock:
+            if channel in self._channels:
+                return
+            self._channels[channel] = room
+        self.start()
+        os.write(self._wake_w, b"x")
+
+    def publish(self, room: str, umkm_id: int, event: str, data: dict):
+        payload = json.dumps({"room": room, "event": event, "data": data}, separators=(",", ":"))
+        if len(payload.encode("utf-8")) > self.MAX_PAYLOAD_BYTES:
+            payload = json.dumps({"room": room, "event": "refresh"})
+        self._notify(self.channel_for(umkm_id), payload)
+
+    def _notify(self, channel: str, payload: str):
+        with self.app.app_context():
+            with db.engine.connect() as conn:
+                conn.execute(db.text("SELECT pg_notify(:channel, :payload)"),
+                             {"channel": channel, "payload": payload})
+                conn.commit()
+
+    def run_forever(self):
+        reconnect = False
+        while True:
+            try:
+                self._listen(refresh_all=reconnect)
+            except Exception as e:
+                print("Error LISTEN/NOTIFY:", e)
+            reconnect = True
+            self.sio.sleep(2)
+
+    def _listen(self, refresh_all: bool):
+        with self.app.app_context():
+            pooled = db.engine.raw_connection()
+        # koneksi khusus LISTEN, dikeluarkan dari pool SQLAlchemy
+        pooled.detach()
+        conn = pooled.driver_connection
+        conn.autocommit = True
+        listening = set()
+
+        try:
+            while True:
+                with self._lock:
+                    wanted = dict(self._channels)
+                cursor = conn.cursor()
+                for channel in wanted.keys() - listening:
+                    cursor.execute(f'LISTEN "{channel}"')
+                    listening.add(channel)
+                cursor.close()
+
+                if refresh_all:
+                    refresh_all = False
+                    for room in wanted.values():
+                        self._deliver_refresh(room)
+
+                ready, _, _ = select.select([conn, self._wake_r], [], [], 30)
+                if self._wake_r in ready:
+                    os.read(self._wake_r, 1024)
+
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    self._deliver(notify.payload, notify.channel)
+        finally:
+            conn.close()
+
+    def _deliver(self, payload: str, channel: str = None):
+        message = json.loads(payload)
+        if message["event"] == "refresh":
+            self._deliver_refresh(message["room"])
+        else:
+            umkm_id = int(channel.rsplit("_", 1)[1]) if channel else None
+            service_seconds = message["data"].get("service_seconds")
+            if umkm_id and service_seconds is not None:
+                # samakan estimasi durasi layanan dengan worker yang menangani tombol kasir
+                service_estimator.set(umkm_id, service_seconds)
+            if umkm_id:
+                queue_version_notifier.notify(umkm_id)
+            self.sio.emit(message["event"], message["data"], room=message["room"])
+
+    def _deliver_refresh(self, room: str):
+        with self.app.app_context():
+            umkm = UMKM.query.filter_by(slug=room).first()
+            if umkm:
+                queue_version_notifier.notify(umkm.id)
+                self.sio.emit("queue_update", queue_snapshot_payload(get_queue_snapshot(umkm)), room=room)
+
+
+pg_fanout = PostgresFanout(app, socketio)
+
+
+class QueueVersionNotifier:
+    """
+    Membangunkan request long-poll (api_queue_state) begitu versi antrian UMKM berubah di proses ini:
+    tiap UMKM yang sedang ditunggu punya satu event; notify() men-set event itu lalu membuangnya,
+    jadi penunggu berikutnya dapat event baru. Event dibuat lewat async mode Socket.IO
+    (green event di eventlet), jadi menunggu tidak memblokir worker.
+    """
+
+    def __init__(self, sio):
+        self.sio = sio
+        self._events = {}  # umkm_id -> event
+        self._lock = threading.Lock()
+
+    def event_for(self, umkm_id: int):
+        """Ambil event SEBELUM membaca versi, supaya perubahan di antaranya tidak terlewat."""
+        with self._lock:
+            event = self._events.get(umkm_id)
+            if event is None:
+                event = self._events[umkm_id] = self.sio.server.eio.create_event()
+            return event
+
+    def notify(self, umkm_id: int):
+        with self._lock:
+            event = self._events.pop(umkm_id, None)
+        if event is not None:
+            event.set()
+
+
+queue_version_notifier = QueueVersionNotifier(socketio)
+
+
+def broadcast_queue_delta(umkm: UMKM, version: int, ops: list):
+    """
+    Broadcast perubahan kecil (delta) setelah commit, lalu terapkan juga ke snapshot di memori.
+    - version: hasil bump_queue_version di transaksi perubahan ini.
+    - ops: list (op, QueueEntry), op = "added" / "called" / "removed".
+    Client yang versinya bukan base_version (ada delta yang terlewat) minta queue_resync.
+    service_seconds (estimasi durasi layanan terbaru) ikut dikirim supaya client bisa
+    menghitung ulang ETA tiap tiket tanpa snapshot lengkap.
+    """
+    update_cached_snapshot(umkm.id, version, ops)
+
+    queue_broadcaster.publish_delta(umkm, version, [
+        {
+            "op": op,
+            "ticket": {
+                "number": entry.queue_number,
+                "name": entry.customer_name or "Tanpa nama"
+            }
+        } for op, entry in ops
+    ], service_estimator.get(umkm.id))
+    queue_version_notifier.notify(umkm.id)
+
+
+def emit_queue_snapshot(umkm: UMKM):
+    """Kirim snapshot lengkap hanya ke client yang meminta (join / resync)."""
+    emit("queue_update", queue_snapshot_payload(get_queue_snapshot(umkm)))
+
+
+@socketio.on("join_display")
+def handle_join_display(data):
+    """
+    Dipanggil dari halaman display untuk bergabung ke 'room' UMKM tertentu.
+    Room yang dipakai: slug UMKM. Client langsung dapat snapshot lengkap + versinya.
+    """
+    room = data.get("room")
+    if not room:
+        return
+    umkm = UMKM.query.filter_by(slug=room).first()
+    if not umkm:
+        return
+
+    join_room(room)
+    if app.config["SOCKETIO_BACKEND"] == "postgres":
+        pg_fanout.subscribe(umkm.id, room)
+    emit_queue_snapshot(umkm)
+
+
+@socketio.on("queue_resync")
+def handle_queue_resync(data):
+    """Client mendeteksi versi yang loncat (delta terlewat) → kirim ulang snapshot lengkap."""
+    umkm = UMKM.query.filter_by(slug=data.get("room")).first()
+    if umkm:
+        emit_queue_snapshot(umkm)
+
+# identitas login yang disimpan di session (cookie bertanda tangan), jadi tanpa query
+Identity = namedtuple("Identity", ["user_id", "umkm_id"])
+
+
+def login_session(user: User, umkm):
+    session["user_id"] = user.id
+    session["umkm_id"] = umkm.id if umkm else None
+
+
+def current_identity():
+    """
+    Identity user yang login (atau None), di-resolve sekali per request ke flask.g.
+    Session lama yang baru berisi user_id dilengkapi sekali dengan satu query kecil.
+    """
+    if "identity" not in g:
+        identity = None
+        user_id = session.get("user_id")
+        if user_id:
+            if "umkm_id" not in session:
+                session["umkm_id"] = (
+                    db.session.query(UMKM.id).filter(UMKM.user_id == user_id).limit(1).scalar()
+                )
+            identity = Identity(user_id, session["umkm_id"])
+        g.identity = identity
+    return g.identity
+
+
+def get_current_umkm():
+    """
+    UMKM milik user login sebagai objek ORM (satu query by id, tanpa load User).
+    Pakai ini kalau UMKM akan diubah atau butuh nilai terbaru (queue_version, kredit).
+    None kalau session basi (UMKM dihapus / pindah pemilik).
+    """
+    identity = current_identity()
+    if not identity or not identity.umkm_id:
+        return None
+    if "current_umkm" not in g:
+        umkm = db.session.get(UMKM, identity.umkm_id)
+        g.current_umkm = umkm if umkm is not None and umkm.user_id == identity.user_id else None
+    return g.current_umkm
+
+
+umkm_cache = LRUCache(app.config["UMKM_CACHE_SIZE"])
+
+
+def get_cached_umkm(umkm_id: int):
+    """
+    Snapshot baris UMKM (Row read-only, atribut sama dengan kolom UMKM) dari cache per proses
+    dengan TTL UMKM_CACHE_TTL_SECONDS. HANYA untuk id/user_id/slug/nama: kolom lain (kredit,
+    queue_version, ticker, ...) bisa tertinggal sampai TTL habis, pakai get_current_umkm untuk itu.
+    Dibuang oleh invalidate_umkm_cache hanya saat salah satu dari keempat kolom itu berubah.
+    """
+    if not umkm_id:
+        return None
+    now = time.monotonic()
+    cached = umkm_cache.get(umkm_id)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    row = db.session.execute(db.select(UMKM.__table__).where(UMKM.id == umkm_id)).first()
+    if row is not None:
+        umkm_cache.set(umkm_id, (now + app.config["UMKM_CACHE_TTL_SECONDS"], row))
+    return row
+
+
+def invalidate_umkm_cache(umkm_id: int):
+    umkm_cache.pop(umkm_id)
+
+
+def get_current_umkm_cached():
+    """UMKM user login dari cache, None kalau session basi (UMKM dihapus / pindah pemilik)."""
+    identity = current_identity()
+    row = get_cached_umkm(identity.umkm_id) if identity else None
+    if row is None or row.user_id != identity.user_id:
+        return None
+    return row
+
+
+def dialect_insert(model):
+    """insert() sesuai dialect database aktif, supaya bisa pakai ON CONFLICT."""
+    if db.engine.dialect.name == "postgresql":
+        return pg_insert(model)
+    return sqlite_insert(model)
+
+
+def allocate_queue_number(umkm_id: int, service_day: date) -> int:
+    """
+    Ambil nomor antrian berikutnya untuk UMKM pada hari layanan tertentu.
+    - Satu statement atomik: INSERT ... ON CONFLICT DO UPDATE ... RETURNING di queue_counters.
+    - Tidak perlu scan tabel queues, dan aman walau beberapa worker melayani UMKM yang sama.
+    - Baris counter terkunci sampai transaksi pemanggil commit, jadi commit secepatnya.
+    """
+    stmt = dialect_insert(QueueCounter).values(
+        umkm_id=umkm_id,
+        service_date=service_day,
+        last_number=1
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[QueueCounter.umkm_id, QueueCounter.service_date],
+        set_={"last_number": QueueCounter.last_number + 1}
+    ).returning(QueueCounter.last_number)
+    return db.session.execute(stmt).scalar_one()
+
+
+class WAGatewayClient:
+    """
+    Klien HTTP ke gateway WA:
+    - satu requests.Session dengan pool koneksi keep-alive (tanpa handshake TCP+TLS tiap pesan),
+    - timeout connect & read terpisah,
+    - circuit breaker: setelah WA_BREAKER_THRESHOLD kegagalan beruntun, semua kiriman
+      langsung ditolak ("circuit_open") selama cooldown, lalu satu kiriman percobaan dibiarkan lewat;
+      hanya hasil kiriman percobaan itu yang menutup / membuka lagi breaker,
+    - counter latency & error untuk /admin/metrics.
+    """
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=flask_app.config["WA_HTTP_POOL_SIZE"]
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0.0
+        self._trial_running = False
+        self.counters = {
+            "requests": 0,
+            "success": 0,
+            "errors": 0,
+            "rejected_open": 0,
+            "breaker_opened": 0,
+            "latency_ms_total": 0.0,
+            "latency_ms_max": 0.0,
+        }
+
+    def is_open(self) -> bool:
+        with self._lock:
+            return time.monotonic() < self._open_until
+
+    def _allow(self):
+        """Return (boleh_kirim, kiriman_percobaan)."""
+        with self._lock:
+            if self._failures < self.app.config["WA_BREAKER_THRESHOLD"]:
+                return True, False
+            if time.monotonic() < self._open_until or self._trial_running:
+                self.counters["rejected_open"] += 1
+                return False, False
+            # cooldown habis: satu kiriman percobaan (half-open)
+            self._trial_running = True
+            return True, True
+
+    def _record(self, ok: bool, latency_ms: float, trial: bool):
+        with self._lock:
+            self.counters["requests"] += 1
+            self.counters["latency_ms_total"] += latency_ms
+            self.counters["latency_ms_max"] = max(self.counters["latency_ms_max"], latency_ms)
+            self.counters["success" if ok else "errors"] += 1
+
+            tripped = self._failures >= self.app.config["WA_BREAKER_THRESHOLD"]
+            if trial:
+                self._trial_running = False
+            elif tripped:
+                # kiriman lama yang baru selesai saat breaker terbuka / half-open:
+                # hanya dihitung di counter, status breaker ditentukan kiriman percobaan
+                return
+
+            if ok:
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._failures >= self.app.config["WA_BREAKER_THRESHOLD"]:
+                self._open_until = time.monotonic() + self.app.config["WA_BREAKER_COOLDOWN_SECONDS"]
+                self.counters["breaker_opened"] += 1
+
+    def send(self, number: str, message: str):
+        """Return (status_code, body), ("error", pesan) atau ("circuit_open", pesan)."""
+        allowed, trial = self._allow()
+        if not allowed:
+            return "circuit_open", "WA gateway circuit open"
+
+        started = time.monotonic()
+        try:
+            r = self.session.post(
+                self.app.config["WA_API_URL"],
+                json={"number": number, "message": message},
+                timeout=(self.app.config["WA_CONNECT_TIMEOUT"], self.app.config["WA_READ_TIMEOUT"])
+            )
+        except Exception as e:
+            # Jika error jaringan / timeout
+            self._record(False, (time.monotonic() - started) * 1000, trial)
+            return "error", str(e)
+
+        # 4xx (misal nomor tidak valid) bukan tanda gateway bermasalah
+        self._record(r.status_code < 500 and r.status_code != 429, (time.monotonic() - started) * 1000, trial)
+        return r.status_code, r.text
+
+    def stats(self) -> dict:
+        with self._lock:
+            data = dict(self.counters)
+            data["state"] = (
+                "open" if time.monotonic() < self._open_until
+                else "half_open" if self._failures >= self.app.config["WA_BREAKER_THRESHOLD"]
+                else "closed"
+            )
+            data["consecutive_failures"] = self._failures
+        data["error_rate"] = round(data["errors"] / data["requests"], 4) if data["requests"] else 0.0
+        data["latency_ms_avg"] = round(data["latency_ms_total"] / data["requests"], 1) if data["requests"] else 0.0
+        data["latency_ms_total"] = round(data["latency_ms_total"], 1)
+        data["latency_ms_max"] = round(data["latency_ms_max"], 1)
+        return data
+
+
+wa_gateway = WAGatewayClient(app)
+
+
+def send_whatsapp_notification(number: str, message: str):
+    """
+    Fungsi integrasi WhatsApp ke API SUKIPLI (lewat wa_gateway).
+    Route jangan panggil langsung, pakai enqueue_whatsapp supaya request tidak menunggu gateway.
+    """
+    return wa_gateway.send(number, message)
+
+
+QR_MIMETYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+# (slug, box_size, format) → (etag, bytes), isi QR selalu PUBLIC_BASE_URL/<slug>
+qr_cache = LRUCache(app.config["QR_CACHE_SIZE"])
+
+
+def umkm_public_url(base_url: str, slug: str) -> str:
+    return f"{base_url.rstrip('/')}/{slug}"  # misal: http://localhost:5000/barbershop-andi
+
+
+def render_qr(url: str, fmt: str = "png", box_size: int = 10) -> bytes:
+    """Render QR code ke bytes di memori (PNG atau SVG), tanpa menulis file."""
+    if fmt == "svg":
+        img = qrcode.make(url, box_size=box_size, image_factory=qrcode.image.svg.SvgPathImage)
+    else:
+        img = qrcode.make(url, box_size=box_size)
+    buf = io.BytesIO()
+    img.save(buf)
+    return buf.getvalue()
+
+
+def send_auto_reminders(umkm: UMKM, base_url: str, current_number: int):
+    """
+    Kirim WA otomatis untuk antrian yang jaraknya <= 3 nomor lagi.
+    - Hanya untuk HARI INI.
+    - Hanya kirim sekali per antrian (cek message_kind AUTO_REMINDER di WALog & outbox).
+    - Semua tiket yang layak dipilih dalam satu query; tiap pesan memesan 1 kredit (credit_reserve),
+      berhenti begitu kredit habis.
+    - Semua pesan masuk outbox dalam satu commit; worker mengirimnya paralel.
+    - base_url: request.url_root dari route pemanggil.
+    - current_number: nomor yang baru saja dipanggil.
+    """
+    today = date.today()
+    base_url = base_url.rstrip("/")
+
+    already_reminded = db.or_(
+        db.session.query(WALog.id).filter(
+            WALog.queue_id == Queue.id,
+            WALog.message_kind == "AUTO_REMINDER"
+        ).exists(),
+        db.session.query(WAOutbox.id).filter(
+            WAOutbox.queue_id == Queue.id,
+            WAOutbox.kind == "AUTO_REMINDER"
+        ).exists()
+    )
+
+    eligible = (
+        Queue.query
+        .filter(
+            Queue.umkm_id == umkm.id,
+            Queue.service_date == today,
+            Queue.status == "waiting",
+            Queue.queue_number > current_number,
+            Queue.queue_number <= current_number + 3,
+            Queue.customer_phone.isnot(None),
+            Queue.customer_phone != "",
+            ~already_reminded
+        )
+        .order_by(Queue.queue_number.asc())
+        .all()
+    )
+
+    if not eligible:
+        return
+
+    queued = 0
+    for q in eligible:
+        ahead = q.queue_number - current_number - 1
+
+        if ahead <= 0:
+            status_text = "giliran Anda hampir tiba (berikutnya)."
+        else:
+            status_text = f"tinggal {ahead} orang di depan Anda."
+
+        ticket_url = f"{base_url}/{umkm.slug}?ticket_id={q.id}"
+
+        msg = (
+            f"[AUTO_REMINDER] Halo {q.customer_name or 'Pelanggan'}, ini dari {umkm.name}. "
+            f"Antrian Anda #{q.queue_number} {status_text} "
+            f"Cek status antrian di sini: {ticket_url}"
+        )
+
+        row = enqueue_whatsapp(
+            q.customer_phone, msg, "AUTO_REMINDER",
+            umkm_id=umkm.id,
+            queue_id=q.id,
+            credit_description=f"Auto reminder ke #{q.queue_number}"
+        )
+        if row is None:
+            break  # kredit habis, tiket berikutnya tidak dikirimi
+        queued += 1
+
+    if queued:
+        db.session.commit()
+        wake_wa_outbox()
+
+
+# --------------------------------------------------
+# ARSIP: TIKET HARI SEBELUMNYA
+# --------------------------------------------------
+# Route antrian hanya menyentuh tiket hari ini, jadi tiket lama dipindah ke queues_archive
+# (flask archive-queues, dijadwalkan tiap malam). Yang butuh riwayat (statistik) membaca
+# gabungan kedua tabel lewat queue_history.
+
+QUEUE_HISTORY_COLUMNS = (
+    "id", "umkm_id", "queue_number", "customer_name", "customer_phone", "status",
+    "service_date", "created_at", "called_at", "finished_at", "canceled_at"
+)
+
+
+def queue_history(umkm_id: int = None, start: date = None, end: date = None):
+    """
+    Subquery UNION ALL tiket di queues & queues_archive dengan kolom QUEUE_HISTORY_COLUMNS.
+    Filter UMKM & hari layanan [start, end] dipasang di tiap cabang supaya index masing-masing
+    tabel tetap terpakai.
+    """
+    parts = []
+    for model in (Queue, QueueArchive):
+        stmt = db.select(*[getattr(model, name).label(name) for name in QUEUE_HISTORY_COLUMNS])
+        if umkm_id is not None:
+            stmt = stmt.where(model.umkm_id == umkm_id)
+        if start is not None:
+            stmt = stmt.where(model.service_date >= start)
+        if end is not None:
+            stmt = stmt.where(model.service_date <= end)
+        parts.append(stmt)
+    return db.union_all(*parts).subquery("queue_history")
+
+
+def archive_queues(before: date, batch_size: int = 5000) -> int:
+    """
+    Pindahkan tiket dengan hari layanan < before ke queues_archive, per batch id
+    (INSERT ... SELECT lalu DELETE dalam satu transaksi), supaya tidak mengunci tabel lama-lama.
+    Counter nomor antrian hari-hari itu ikut dihapus. Return jumlah tiket yang dipindah.
+    """
+    columns = [Queue.__table__.c[name] for name in QUEUE_HISTORY_COLUMNS]
+    moved = 0
+    while True:
+        ids = [
+            queue_id for (queue_id,) in
+            db.session.query(Queue.id)
+            .filter(Queue.service_date < before)
+            .order_by(Queue.id.asc())
+            .limit(batch_size)
+        ]
+        if not ids:
+            break
+        db.session.execute(
+            db.insert(QueueArchive).from_select(
+                list(QUEUE_HISTORY_COLUMNS),
+                db.select(*columns).where(Queue.id.in_(ids))
+            )
+        )
+        db.session.execute(db.delete(Queue).where(Queue.id.in_(ids)))
+        db.session.commit()
+        moved += len(ids)
+
+    db.session.execute(db.delete(QueueCounter).where(QueueCounter.service_date < before))
+    db.session.commit()
+    return moved
+
+
+# --------------------------------------------------
+# STATISTIK: ROLLUP PER JAM
+# --------------------------------------------------
+# Setiap tiket menyumbang ke satu baris queue_stats_hourly (jam created_at-nya). Saat status
+# tiket berubah, hanya selisih sumbangannya yang di-upsert, jadi isi rollup selalu sama dengan
+# hasil hitung ulang dari riwayat tiket (rebuild_queue_stats).
+
+QUEUE_STATS_FIELDS = ("issued", "served", "no_show", "canceled", "sum_wait", "sum_service")
+
+
+def ticket_stats(q) -> dict:
+    """Sumbangan satu tiket ke rollup, sesuai statusnya sekarang."""
+    stats = dict.fromkeys(QUEUE_STATS_FIELDS, 0)
+    stats["issued"] = 1
+    if q.status == "done":
+        stats["served"] = 1
+        # tanpa finished_at (data lama) durasi layanan tidak diketahui: jangan ditebak dari jam
+        # sekarang, supaya rebuild berulang & delta live selalu menghasilkan angka yang sama
+        served_at = q.called_at or q.finished_at
+        if served_at:
+            stats["sum_wait"] = (served_at - q.created_at).total_seconds()
+        if q.called_at and q.finished_at:
+            stats["sum_service"] = (q.finished_at - q.called_at).total_seconds()
+    elif q.status == "no_show":
+        stats["no_show"] = 1
+    elif q.status == "canceled":
+        stats["canceled"] = 1
+    return stats
+
+
+def stats_hour(moment: datetime) -> datetime:
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def lock_queue_stats(umkm_id: int = None):
+    """
+    Kunci rollup satu UMKM (None = semua) sampai transaksi pemanggil selesai, lewat baris umkm:
+    Postgres SELECT ... FOR UPDATE, SQLite UPDATE kosong (ambil write lock database).
+    Dipakai delta live & rebuild_queue_stats supaya rebuild tidak menimpa delta yang
+    di-commit di antara baca riwayat dan tulis ulang rollup.
+    """
+    if db.engine.dialect.name == "sqlite":
+        stmt = db.update(UMKM).values(queue_version=UMKM.queue_version)
+        if umkm_id is not None:
+            stmt = stmt.where(UMKM.id == umkm_id)
+        db.session.execute(stmt.execution_options(synchronize_session=False))
+        return
+    stmt = db.select(UMKM.id).order_by(UMKM.id).with_for_update()
+    if umkm_id is not None:
+        stmt = stmt.where(UMKM.id == umkm_id)
+    db.session.execute(stmt).all()
+
+
+def upsert_queue_stats(umkm_id: int, hour: datetime, delta: dict):
+    """Tambahkan delta ke satu baris rollup (INSERT ... ON CONFLICT DO UPDATE, belum commit)."""
+    stmt = dialect_insert(QueueStatsHourly).values(umkm_id=umkm_id, hour=hour, **delta)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[QueueStatsHourly.umkm_id, QueueStatsHourly.hour],
+        set_={k: getattr(QueueStatsHourly, k) + getattr(stmt.excluded, k) for k in delta}
+    )
+    db.session.execute(stmt)
+
+
+def record_ticket_stats(q, before: dict = None):
+    """
+    Catat perubahan tiket ke rollup di transaksi pemanggil.
+    before = ticket_stats(q) sebelum status diubah; None untuk tiket baru.
+    """
+    after = ticket_stats(q)
+    delta = {k: after[k] - (before or {}).get(k, 0) for k in QUEUE_STATS_FIELDS}
+    if any(delta.values()):
+        lock_queue_stats(q.umkm_id)
+        upsert_queue_stats(q.umkm_id, stats_hour(q.created_at), delta)
+
+
+def rebuild_queue_stats(umkm_id: int = None):
+    """
+    Hitung ulang rollup dari riwayat tiket, queues + queues_archive (semua UMKM atau satu UMKM).
+    Baca riwayat & tulis ulang rollup dalam satu transaksi di bawah lock_queue_stats.
+    """
+    lock_queue_stats(umkm_id)
+    stats_query = QueueStatsHourly.query
+    if umkm_id is not None:
+        stats_query = stats_query.filter(QueueStatsHourly.umkm_id == umkm_id)
+    history = queue_history(umkm_id)
+    tickets = db.session.execute(
+        db.select(history).where(history.c.created_at.isnot(None)),
+        execution_options={"yield_per": 5000}
+    )
+
+    buckets = {}
+    for q in tickets:
+        bucket = buckets.setdefault((q.umkm_id, stats_hour(q.created_at)), dict.fromkeys(QUEUE_STATS_FIELDS, 0))
+        for k, v in ticket_stats(q).items():
+            bucket[k] += v
+
+    stats_query.delete(synchronize_session=False)
+    rows = [{"umkm_id": u, "hour": h, **values} for (u, h), values in buckets.items()]
+    for i in range(0, len(rows), 1000):
+        db.session.execute(db.insert(QueueStatsHourly), rows[i:i + 1000])
+    db.session.commit()
+    return len(rows)
+
+
+def queue_stats_range(umkm_id: int, start: date, end: date, by_day: bool = False) -> list:
+    """
+    Rollup [start, end] (tanggal inklusif), range scan di primary key (umkm_id, hour).
+    Return Row biasa (bukan objek ORM): period + QUEUE_STATS_FIELDS, per jam atau, kalau by_day,
+    sudah dijumlah per hari di SQL (GROUP BY), jadi rentang setahun tetap maksimal 366 baris.
+    """
+    if by_day:
+        period = db.func.date(QueueStatsHourly.hour, type_=db.Date)
+        columns = [db.func.sum(getattr(QueueStatsHourly, k)).label(k) for k in QUEUE_STATS_FIELDS]
+    else:
+        period = QueueStatsHourly.hour
+        columns = [getattr(QueueStatsHourly, k) for k in QUEUE_STATS_FIELDS]
+
+    query = (
+        db.session.query(period.label("period"), *columns)
+        .filter(
+            QueueStatsHourly.umkm_id == umkm_id,
+            QueueStatsHourly.hour >= datetime.combine(start, datetime.min.time()),
+            QueueStatsHourly.hour < datetime.combine(end + timedelta(days=1), datetime.min.time())
+        )
+    )
+    if by_day:
+        query = query.group_by(period)
+    return query.order_by(period.asc()).all()
+
+
+# --------------------------------------------------
+# STATISTIK: ESTIMASI WAKTU TUNGGU (ETA)
+# --------------------------------------------------
+# Durasi layanan rata-rata per UMKM disimpan di memori sebagai EWMA dan diperbarui O(1) setiap
+# kali kasir menyelesaikan nomor yang sedang dipanggil (dipanggil → selesai). Query hanya
+# sekali per UMKM per proses, saat snapshot antrian dibangun: nilai awal dari rollup per jam.
+
+class ServiceTimeEstimator:
+    """Rata-rata bergerak eksponensial durasi layanan (detik) per UMKM, thread-safe."""
+
+    def __init__(self, alpha: float, max_sample: float):
+        self.alpha = alpha
+        self.max_sample = max_sample
+        self._seconds = {}  # umkm_id -> detik, None = sudah dicoba seed tapi belum ada data
+        self._lock = threading.Lock()
+
+    def get(self, umkm_id: int):
+        return self._seconds.get(umkm_id)
+
+    def has(self, umkm_id: int) -> bool:
+        return umkm_id in self._seconds
+
+    def seed(self, umkm_id: int, seconds):
+        """Isi nilai awal, hanya kalau belum ada sampel di proses ini."""
+        with self._lock:
+            if self._seconds.get(umkm_id) is None:
+                self._seconds[umkm_id] = seconds
+
+    def set(self, umkm_id: int, seconds: float):
+        """Ambil nilai dari worker lain (lihat PostgresFanout._deliver)."""
+        with self._lock:
+            self._seconds[umkm_id] = seconds
+
+    def observe(self, umkm_id: int, seconds: float) -> float:
+        sample = min(max(seconds, 0.0), self.max_sample)
+        with self._lock:
+            current = self._seconds.get(umkm_id)
+            if current is None:
+                current = sample
+            else:
+                current += self.alpha * (sample - current)
+            self._seconds[umkm_id] = current
+            return current
+
+
+service_estimator = ServiceTimeEstimator(
+    app.config["ETA_EWMA_ALPHA"],
+    app.config["ETA_MAX_SAMPLE_MINUTES"] * 60.0
+)
+
+
+def seed_service_estimate(umkm_id: int):
+    """Nilai awal EWMA dari rollup ETA_SEED_DAYS hari terakhir (sekali per UMKM per proses)."""
+    if service_estimator.has(umkm_id):
+        return
+    since = stats_hour(datetime.now() - timedelta(days=app.config["ETA_SEED_DAYS"]))
+    served, sum_service = (
+        db.session.query(
+            db.func.coalesce(db.func.sum(QueueStatsHourly.served), 0),
+            db.func.coalesce(db.func.sum(QueueStatsHourly.sum_service), 0)
+        )
+        .filter(QueueStatsHourly.umkm_id == umkm_id, QueueStatsHourly.hour >= since)
+        .one()
+    )
+    service_estimator.seed(umkm_id, float(sum_service) / served if served else None)
+
+
+def observe_service_time(q):
+    """
+    Catat durasi layanan tiket yang baru diselesaikan kasir (status called → done).
+    Tiket no_show tidak dihitung: durasinya cuma lama kasir menunggu sebelum skip.
+    """
+    if q.status == "done" and q.called_at and q.finished_at:
+        service_estimator.observe(q.umkm_id, (q.finished_at - q.called_at).total_seconds())
+
+
+def waiting_eta_seconds(snapshot: dict) -> list:
+    """
+    Perkiraan detik sampai tiap tiket waiting dipanggil (urutan sama dengan snapshot["waiting"]):
+    sisa layanan nomor yang sedang dipanggil + posisi x rata-rata durasi layanan.
+    None kalau belum ada data durasi layanan.
+    """
+    avg = service_estimator.get(snapshot["umkm_id"])
+    if avg is None:
+        return [None] * len(snapshot["waiting"])
+
+    current = snapshot["current_called"]
+    first = 0.0
+    if current and current.called_at:
+        first = max(avg - (datetime.now() - current.called_at).total_seconds(), 0.0)
+    return [first + i * avg for i in range(len(snapshot["waiting"]))]
+
+
+def eta_minutes(seconds):
+    return None if seconds is None else int(round(seconds / 60.0))
+
+
+# --------------------------------------------------
+# STATISTIK: ANALITIK WAKTU TUNGGU (NUMPY)
+# --------------------------------------------------
+# Kolom waktu tiket diambil sekaligus sebagai angka epoch (detik) langsung dari database,
+# tanpa objek ORM, lalu dihitung vektor dengan NumPy. Timestamp disimpan tanpa zona waktu,
+# jadi jam & hari dari epoch ini = jam & hari lokal toko.
+
+STATUS_CODES = {"done": 1, "no_show": 2, "canceled": 3}
+WEEKDAY_LABELS = ["Sen", "Sel", "Rab", "Kam", "Jum", "Sab", "Min"]
+
+
+def sql_epoch(column):
+    """Ekspresi SQL: timestamp → detik epoch (float), NULL tetap NULL."""
+    if db.engine.dialect.name == "postgresql":
+        # EXTRACT mengembalikan numeric (→ Decimal di psycopg2), cast supaya langsung float
+        return db.cast(db.extract("epoch", column), db.Float)
+    return (db.func.julianday(column) - 2440587.5) * 86400.0
+
+
+def fetch_queue_columns(umkm_id: int, start: date, end: date) -> np.ndarray:
+    """
+    Array float (n, 4): created, called, finished (epoch detik, NaN kalau kosong) & kode status
+    (STATUS_CODES, 0 = masih aktif) untuk tiket hari layanan [start, end].
+    """
+    history = queue_history(umkm_id, start, end)
+    status_code = db.case(
+        *[(history.c.status == status, code) for status, code in STATUS_CODES.items()],
+        else_=0
+    )
+    result = db.session.connection().execute(
+        db.select(
+            sql_epoch(history.c.created_at),
+            sql_epoch(history.c.called_at),
+            sql_epoch(history.c.finished_at),
+            status_code
+        )
+    )
+    # tuple mentah dari cursor DBAPI (tanpa objek Row SQLAlchemy), None → NaN
+    rows = result.cursor.fetchall()
+    result.close()
+    if not rows:
+        return np.empty((0, 4))
+    return np.array(rows, dtype=float)
+
+
+def percentiles_minutes(seconds: np.ndarray) -> dict:
+    seconds = seconds[np.isfinite(seconds) & (seconds >= 0)]
+    if not seconds.size:
+        return None
+    p50, p90, p99 = np.percentile(seconds, [50, 90, 99]) / 60
+    return {"p50": p50, "p90": p90, "p99": p99, "count": int(seconds.size)}
+
+
+def queue_analytics(umkm_id: int, start: date, end: date) -> dict:
+    """Persentil waktu tunggu & layanan, tingkat tidak hadir, dan heatmap hari × jam."""
+    data = fetch_queue_columns(umkm_id, start, end)
+    created, called, finished, status = data.T
+
+    served = status == STATUS_CODES["done"]
+    no_show = status == STATUS_CODES["no_show"]
+    wait = called - created
+    service = np.where(served, finished - called, np.nan)
+
+    # heatmap: jumlah tiket & rata-rata tunggu per (hari, jam) tiket diambil
+    valid = np.isfinite(created)
+    slot = ((created[valid] // 86400 + 3) % 7 * 24 + created[valid] // 3600 % 24).astype(int)
+    counts = np.bincount(slot, minlength=7 * 24)
+    waited = np.isfinite(wait[valid])
+    wait_sum = np.bincount(slot[waited], weights=wait[valid][waited], minlength=7 * 24)
+    wait_count = np.bincount(slot[waited], minlength=7 * 24)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        avg_wait = np.where(wait_count > 0, wait_sum / wait_count / 60, np.nan)
+
+    attended = int(served.sum() + no_show.sum())
+    return {
+        "tickets": int(data.shape[0]),
+        "wait": percentiles_minutes(wait),
+        "service": percentiles_minutes(service),
+        "no_show_rate": float(no_show.sum()) / attended if attended else None,
+        "heatmap": counts.reshape(7, 24).tolist(),
+        "heatmap_max": int(counts.max()) if counts.size else 0,
+        "heatmap_wait": [
+            [None if np.isnan(v) else round(float(v), 1) for v in row]
+            for row in avg_wait.reshape(7, 24)
+        ],
+    }
+
+
+# --------------------------------------------------
+# KREDIT: LEDGER ATOMIK
+# --------------------------------------------------
+# Saldo hanya diubah lewat fungsi di bawah: satu UPDATE bersyarat per perubahan (tanpa baca-ubah-tulis
+# di objek ORM) + CreditLog di transaksi yang sama. Semua belum commit, ikut transaksi pemanggil.
+# Pesan WA berbayar memakai reserve → commit/release supaya cek kredit tidak menahan lock
+# selama request HTTP ke gateway.
+
+def _credit_update(umkm_id: int, condition, **values):
+    """UPDATE umkm ... WHERE id = umkm_id AND condition RETURNING credit_balance. None = syarat gagal."""
+    stmt = db.update(UMKM).where(UMKM.id == umkm_id)
+    if condition is not None:
+        stmt = stmt.where(condition)
+    return db.session.execute(
+        stmt.values(**values)
+        .returning(UMKM.credit_balance)
+        .execution_options(synchronize_session=False)
+    ).scalar_one_or_none()
+
+
+def credit_debit(umkm_id: int, amount: int, description: str):
+    """Potong saldo kalau cukup. Return saldo baru, atau None kalau saldo kurang (tidak ada yang berubah)."""
+    balance = _credit_update(
+        umkm_id, UMKM.credit_balance >= amount,
+        credit_balance=UMKM.credit_balance - amount
+    )
+    if balance is not None:
+        db.session.add(CreditLog(umkm_id=umkm_id, change=-amount, description=description))
+    return balance
+
+
+def credit_add(umkm_id: int, amount: int, description: str) -> int:
+    """Tambah saldo (top-up / bonus). Return saldo baru."""
+    balance = _credit_update(umkm_id, None, credit_balance=UMKM.credit_balance + amount)
+    db.session.add(CreditLog(umkm_id=umkm_id, change=amount, description=description))
+    return balance
+
+
+def credit_reserve(umkm_id: int, amount: int = 1) -> bool:
+    """Pesan kredit untuk pesan yang belum terkirim: pindah dari credit_balance ke credit_reserved."""
+    balance = _credit_update(
+        umkm_id, UMKM.credit_balance >= amount,
+        credit_balance=UMKM.credit_balance - amount,
+        credit_reserved=UMKM.credit_reserved + amount
+    )
+    return balance is not None
+
+
+def credit_commit(umkm_id: int, descriptions: list):
+    """Reservasi jadi terpakai (pesan terkirim): satu UPDATE, satu CreditLog per pesan."""
+    if not descriptions:
+        return
+    _credit_update(umkm_id, None, credit_reserved=UMKM.credit_reserved - len(descriptions))
+    db.session.add_all([
+        CreditLog(umkm_id=umkm_id, change=-1, description=description)
+        for description in descriptions
+    ])
+
+
+def credit_release(umkm_id: int, amount: int = 1):
+    """Reservasi batal (pesan gagal permanen): kredit kembali ke saldo, tanpa CreditLog."""
+    if amount:
+        _credit_update(
+            umkm_id, None,
+            credit_balance=UMKM.credit_balance + amount,
+            credit_reserved=UMKM.credit_reserved - amount
+        )
+
+
+# --------------------------------------------------
+# WA OUTBOX (KIRIM WA DI BACKGROUND)
+# --------------------------------------------------
+
+def enqueue_whatsapp(number: str, message: str, kind: str, umkm_id: int = None,
+                     queue_id: int = None, credit_description: str = None):
+    """
+    Masukkan pesan WA ke outbox (belum commit, ikut transaksi pemanggil).
+    - credit_description diisi = pesan berbayar: 1 kredit langsung dipesan (credit_reserve),
+      jadi terpakai setelah terkirim atau kembali kalau gagal. Return None kalau kredit tidak cukup.
+    - Panggil wake_wa_outbox() setelah commit supaya worker langsung jalan.
+    """
+    if credit_description is not None and not credit_reserve(umkm_id):
+        return None
+
+    row = WAOutbox(
+        umkm_id=umkm_id,
+        queue_id=queue_id,
+        phone_number=number,
+        message=message,
+        kind=kind,
+        charge_credit=credit_description is not None,
+        credit_description=credit_description
+    )
+    db.session.add(row)
+    return row
+
+
+def claim_due_outbox(limit: int) -> list:
+    """
+    Klaim pesan yang jatuh tempo dengan UPDATE bersyarat per baris (status pending → sending).
+    Aman dipakai beberapa proses sekaligus: baris yang sudah diklaim proses lain tidak ikut.
+    Pesan "sending" yang lease-nya habis (worker mati di tengah jalan) diklaim ulang.
+    """
+    now = datetime.now()
+    lease_expired = now - timedelta(seconds=app.config["WA_OUTBOX_LEASE_SECONDS"])
+    claimable = db.or_(
+        db.and_(WAOutbox.status == "pending", WAOutbox.next_attempt_at <= now),
+        db.and_(WAOutbox.status == "sending", WAOutbox.locked_at < lease_expired)
+    )
+
+    candidate_ids = [
+        row_id for (row_id,) in
+        db.session.query(WAOutbox.id)
+        .filter(claimable)
+        .order_by(WAOutbox.next_attempt_at.asc())
+        .limit(limit)
+        .all()
+    ]
+
+    claimed = []
+    for row_id in candidate_ids:
+        result = db.session.execute(
+            db.update(WAOutbox)
+            .where(WAOutbox.id == row_id, claimable)
+            .values(status="sending", locked_at=now)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 1:
+            claimed.append(row_id)
+    db.session.commit()
+
+    if not claimed:
+        return []
+    return WAOutbox.query.filter(WAOutbox.id.in_(claimed)).all()
+
+
+def truncate_text(value, limit: int):
+    """str(value) dipotong ke limit karakter (respons gateway bisa berupa halaman HTML error)."""
+    if value is None:
+        return None
+    text = str(value)
+    return text if len(text) <= limit else text[:limit] + "…[dipotong]"
+
+
+def outbox_retry_delay(attempts: int) -> timedelta:
+    """Backoff eksponensial: base, 2x base, 4x base, ... maksimal 1 jam."""
+    base = app.config["WA_OUTBOX_RETRY_BASE_SECONDS"]
+    return timedelta(seconds=min(base * 2 ** max(attempts - 1, 0), 3600))
+
+
+def finish_outbox_row(row: WAOutbox, status, raw):
+    """
+    Catat hasil kirim satu pesan (belum commit). Untuk pesan berbayar return "commit" / "release"
+    (nasib kredit yang dipesan), selain itu None.
+    - 200 → sent, tulis WALog; kredit pesan berbayar jadi terpakai.
+    - error jaringan / 5xx / 429 → coba lagi dengan backoff sampai WA_OUTBOX_MAX_ATTEMPTS.
+    - circuit breaker terbuka → dicoba lagi setelah cooldown, tidak dihitung sebagai percobaan.
+    - selain itu (misal nomor tidak valid) → failed, tulis WALog, kredit kembali ke saldo.
+    """
+    now = datetime.now()
+    row.locked_at = None
+
+    if status == "circuit_open":
+        row.status = "pending"
+        row.next_attempt_at = now + timedelta(seconds=app.config["WA_BREAKER_COOLDOWN_SECONDS"])
+        return None
+
+    row.attempts += 1
+
+    retryable = status == "error" or status == 429 or (isinstance(status, int) and status >= 500)
+    if status != 200 and retryable and row.attempts < app.config["WA_OUTBOX_MAX_ATTEMPTS"]:
+        row.status = "pending"
+        row.next_attempt_at = now + outbox_retry_delay(row.attempts)
+        row.last_error = truncate_text(raw, app.config["WA_LOG_RESPONSE_MAX_CHARS"])
+        return None
+
+    db.session.add(WALog(
+        umkm_id=row.umkm_id,
+        queue_id=row.queue_id,
+        phone_number=row.phone_number,
+        message=row.message,
+        message_kind=row.kind,
+        status=str(status),
+        response_raw=truncate_text(raw, app.config["WA_LOG_RESPONSE_MAX_CHARS"])
+    ))
+
+    charged = row.charge_credit and row.umkm_id
 
+    if status != 200:
+        row.status = "failed"
+        row.last_error = truncate_text(raw, app.config["WA_LOG_RESPONSE_MAX_CHARS"])
+        return "release" if charged else None
 
-class WALog(db.Model):
-    __tablename__ = "wa_logs"
+    row.status = "sent"
+    row.sent_at = now
+    return "commit" if charged else None
 
-    id = db.Column(db.Integer, primary_key=True)
-    umkm_id = db.Column(db.Integer, db.ForeignKey("umkm.id"))
-    queue_id = db.Column(db.Integer, db.ForeignKey("queues.id"))
-    phone_number = db.Column(db.String(30))
-    message = db.Column(db.Text)
-    status = db.Column(db.String(20))  # 200/error/...
-    response_raw = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, default=datetime.now)
 
+class WAOutboxDispatcher:
+    """
+    Worker background yang menguras tabel wa_outbox:
+    - satu thread poller mengklaim pesan yang jatuh tempo,
+    - pengiriman HTTP berjalan paralel di pool WA_OUTBOX_WORKERS thread,
+    - hasil tiap pesan (status + WALog + commit/release kredit) difinalisasi per baris
+      di SAVEPOINT sendiri, lalu satu commit untuk seluruh batch.
+    Di bawah gunicorn eventlet semua thread ini otomatis jadi greenthread.
+    """
 
-class CreditLog(db.Model):
-    __tablename__ = "credit_logs"
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.pool = None
+        self.pid = None
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Jalankan poller sekali per proses (aman dipanggil berulang, juga setelah fork)."""
+        with self._lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.pool = ThreadPoolExecutor(
+                max_workers=self.app.config["WA_OUTBOX_WORKERS"],
+                thread_name_prefix="wa-outbox"
+            )
+            threading.Thread(target=self.run_forever, name="wa-outbox-poller", daemon=True).start()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def run_once(self) -> int:
+        """Klaim, kirim & catat satu batch. Return jumlah pesan yang diproses."""
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.app.config["WA_OUTBOX_WORKERS"])
+
+        # gateway sedang down: jangan klaim apa pun sampai cooldown breaker habis
+        if wa_gateway.is_open():
+            return 0
+
+        with self.app.app_context():
+            rows = claim_due_outbox(self.app.config["WA_OUTBOX_WORKERS"] * 2)
+            if not rows:
+                return 0
+
+            jobs = [(row.phone_number, row.message) for row in rows]
+            results = list(self.pool.map(lambda job: send_whatsapp_notification(*job), jobs))
+
+            # tiap baris difinalisasi di SAVEPOINT sendiri: status + WALog + commit/release kredit
+            # masuk bersama (kontrak ledger: tidak ada kredit yang tertahan di credit_reserved kalau
+            # proses mati di tengah jalan). Error di satu baris tidak membatalkan baris lain yang
+            # sudah terkirim (kalau batal, baris itu tetap "sending", diklaim ulang, pesan dobel).
+            for row, (status, raw) in zip(rows, results):
+                try:
+                    with db.session.begin_nested():
+                        outcome = finish_outbox_row(row, status, raw)
+                        if outcome == "commit":
+                            credit_commit(row.umkm_id, [row.credit_description])
+                        elif outcome == "release":
+                            credit_release(row.umkm_id, 1)
+                except Exception:
+                    self.app.logger.exception("Gagal finalisasi WA outbox #%s", row.id)
+            db.session.commit()
+            return len(rows)
+
+    def run_forever(self):
+        while True:
+            try:
+                processed = self.run_once()
+            except Exception:
+                self.app.logger.exception("Error WA outbox worker")
+                processed = 0
+            if not processed:
+                self._wakeup.wait(self.app.config["WA_OUTBOX_POLL_SECONDS"])
+                self._wakeup.clear()
+
+
+wa_outbox = WAOutboxDispatcher(app)
+
+
+def wake_wa_outbox():
+    """Bangunkan worker setelah ada pesan baru di-commit ke outbox."""
+    if app.config["WA_OUTBOX_AUTOSTART"]:
+        wa_outbox.start()
+    wa_outbox.wake()
+
+
+@app.before_request
+def start_background_workers():
+    if app.config["WA_OUTBOX_AUTOSTART"]:
+        wa_outbox.start()
+
+
+def purge_wa_logs(body_before: datetime, delete_before: datetime = None, batch_size: int = 5000) -> tuple:
+    """
+    Retensi wa_logs & wa_outbox, per batch id supaya tidak mengunci tabel lama-lama:
+    - log sebelum delete_before dihapus (None = tidak ada yang dihapus);
+    - log sebelum body_before dikosongkan message & response_raw-nya, ringkasannya tetap;
+    - pesan outbox sent/failed sebelum body_before dihapus (isinya sudah ada di wa_logs),
+      pesan pending/sending tidak pernah disentuh.
+    Return (jumlah log dikosongkan, jumlah log dihapus, jumlah pesan outbox dihapus).
+    """
+    deleted = 0
+    while delete_before is not None:
+        ids = [
+            log_id for (log_id,) in
+            db.session.query(WALog.id).filter(WALog.created_at < delete_before).limit(batch_size)
+        ]
+        if not ids:
+            break
+        db.session.execute(db.delete(WALog).where(WALog.id.in_(ids)))
+        db.session.commit()
+        deleted += len(ids)
+
+    stripped = 0
+    while True:
+        ids = [
+            log_id for (log_id,) in
+            db.session.query(WALog.id)
+            .filter(
+                WALog.created_at < body_before,
+                db.or_(WALog.message.isnot(None), WALog.response_raw.isnot(None))
+            )
+            .limit(batch_size)
+        ]
+        if not ids:
+            break
+        db.session.execute(
+            db.update(WALog).where(WALog.id.in_(ids)).values(message=None, response_raw=None)
+        )
+        db.session.commit()
+        stripped += len(ids)
+
+    outbox_deleted = 0
+    while True:
+        ids = [
+            row_id for (row_id,) in
+            db.session.query(WAOutbox.id)
+            .filter(WAOutbox.status.in_(("sent", "failed")), WAOutbox.created_at < body_before)
+            .limit(batch_size)
+        ]
+        if not ids:
+            break
+        db.session.execute(db.delete(WAOutbox).where(WAOutbox.id.in_(ids)))
+        db.session.commit()
+        outbox_deleted += len(ids)
 
-    id = db.Column(db.Integer, primary_key=True)
-    umkm_id = db.Column(db.Integer, db.ForeignKey("umkm.id"))
-    change = db.Column(db.Integer)  # + / -
-    description = db.Column(db.String(255))
-    created_at = db.Column(db.DateTime, default=datetime.now)
+    return stripped, deleted, outbox_deleted
 
-class TopupTransaction(db.Model):
-    __tablename__ = "topup_transactions"
 
-    id = db.Column(db.Integer, primary_key=True)
-    umkm_id = db.Column(db.Integer, db.ForeignKey("umkm.id"), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+# --------------------------------------------------
+# MEDIA: PROSES GAMBAR UPLOAD
+# --------------------------------------------------
+# File upload disimpan dulu apa adanya ke file sementara, lalu di-decode, diputar sesuai EXIF,
+# dibuang metadatanya dan di-encode ke WebP per lebar IMAGE_VARIANT_WIDTHS di task background.
+# Nama varian: <base>_<lebar>w.webp; path yang disimpan di DB = varian terbesar.
 
-    package_name = db.Column(db.String(100), nullable=False)
-    credits = db.Column(db.Integer, nullable=False)
-    amount = db.Column(db.Integer, nullable=True)  # nominal rupiah (opsional)
+IMAGE_VARIANT_RE = re.compile(r"^(.*)_(\d+)w\.webp$")
 
-    # gambar QRIS yang digunakan (misal: img/qris_kecil.png)
-    qris_image = db.Column(db.String(255), nullable=True)
-    # path bukti transfer (gambar) yang diupload user
-    proof_image = db.Column(db.String(255), nullable=True)
 
-    # "pending"        = baru pilih paket, belum konfirmasi
-    # "waiting_admin"  = user sudah konfirmasi + upload bukti, menunggu ACC admin
-    # "success"        = admin sudah ACC, kredit sudah masuk
-    # "rejected"       = admin tolak (opsional)
-    status = db.Column(db.String(20), default="pending")
+def run_blocking(fn, *args):
+    """Jalankan pekerjaan CPU-berat (Pillow) tanpa memblokir event loop eventlet."""
+    if socketio.async_mode == "eventlet":
+        from eventlet import tpool
+        return tpool.execute(fn, *args)
+    return fn(*args)
 
-    sender_name = db.Column(db.String(150), nullable=True)
-    note = db.Column(db.String(255), nullable=True)
 
-    created_at = db.Column(db.DateTime, default=datetime.now)
-    confirmed_at = db.Column(db.DateTime, nullable=True)
+def save_upload_tmp(f, folder: str) -> str:
+    """Tulis file upload ke file sementara di folder tujuan (streaming ke disk). Return path-nya."""
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".upload_")
+    with os.fdopen(fd, "wb") as out:
+        f.save(out)
+    return tmp_path
+
+
+def encode_webp_variants(src_path: str, base_path: str, widths) -> str:
+    """
+    Encode gambar ke WebP tanpa metadata untuk setiap lebar di `widths` (maksimal lebar asli).
+    GIF animasi disimpan satu file <base>.webp ukuran asli supaya animasinya tetap jalan.
+    Return path varian terbesar. File sumber selalu dihapus.
+    """
+    quality = app.config["IMAGE_WEBP_QUALITY"]
+    try:
+        with Image.open(src_path) as img:
+            if getattr(img, "is_animated", False):
+                out_path = f"{base_path}.webp"
+                img.save(out_path, "WEBP", save_all=True, quality=quality)
+                return out_path
+
+            img = ImageOps.exif_transpose(img)
+            has_alpha = "A" in img.getbands() or "transparency" in img.info
+            img = img.convert("RGBA" if has_alpha else "RGB")
+
+            out_path = None
+            for width in sorted({min(w, img.width) for w in widths}):
+                height = max(1, round(img.height * width / img.width))
+                variant = img if width == img.width else img.resize((width, height), Image.LANCZOS)
+                out_path = f"{base_path}_{width}w.webp"
+                variant.save(out_path, "WEBP", quality=quality, method=4)
+            return out_path
+    finally:
+        os.remove(src_path)
+
+
+def image_srcset(path: str) -> str:
+    """Nilai atribut srcset untuk gambar hasil encode_webp_variants; gambar lama → string kosong."""
+    match = IMAGE_VARIANT_RE.match(path or "")
+    if not match:
+        return ""
+    base, largest = match.group(1), int(match.group(2))
+    widths = sorted({w for w in app.config["IMAGE_VARIANT_WIDTHS"] if w < largest} | {largest})
+    return ", ".join(f"{media_url(f'{base}_{w}w.webp')} {w}w" for w in widths)
+
+
+def process_image_in_background(tmp_path: str, rel_base: str, widths, on_done):
+    """
+    Proses gambar upload di luar thread request. Setelah selesai, on_done(rel_path) dipanggil
+    di dalam app context (rel_path relatif ke folder static, misal upload/slug/x_960w.webp).
+    """
+    def task():
+        try:
+            out_path = run_blocking(
+                encode_webp_variants, tmp_path, os.path.join("static", rel_base), widths
+            )
+        except Exception as e:
+            print("Error proses gambar upload:", e)
+            return
+
+        rel_path = os.path.relpath(out_path, "static").replace("\\", "/")
+        with app.app_context():
+            try:
+                on_done(rel_path)
+            except Exception as e:
+                db.session.rollback()
+                print("Error simpan gambar upload:", e)
+
+    socketio.start_background_task(task)
+
+
+def upload_rel_base(umkm: UMKM, filename: str, subfolder: str = None) -> str:
+    """upload/<slug>[/subfolder]/<timestamp>_<nama tanpa ekstensi> (tanpa ekstensi)."""
+    stem = secure_filename(filename).rsplit(".", 1)[0] or "gambar"
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    parts = ["upload", umkm.slug] + ([subfolder] if subfolder else []) + [f"{timestamp}_{stem}"]
+    return "/".join(parts)
+
+
+def attach_display_image(umkm_id: int, rel_path: str):
+    """Tambahkan gambar yang sudah diproses ke akhir playlist display UMKM."""
+    abs_path = os.path.join("static", rel_path)
+    add_display_media(
+        umkm_id, "image", rel_path,
+        size=os.path.getsize(abs_path),
+        sha256=run_blocking(file_sha256, abs_path)
+    )
+    db.session.commit()
 
-    umkm = db.relationship("UMKM", backref="topup_transactions", lazy=True)
-    user = db.relationship("User", backref="topup_transactions", lazy=True)
 
 # --------------------------------------------------
-# UTIL: AUTH, QUEUE, WA, QR
+# MEDIA: PLAYLIST DISPLAY (TABEL display_media)
 # --------------------------------------------------
 
-def allowed_file(filename, allowed_ext):
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in allowed_ext
+DISPLAY_MEDIA_GAP = 1024
 
-def broadcast_queue_update(umkm: UMKM):
-    """
-    Broadcast status antrian ke semua client display (mode TV) untuk UMKM ini.
-    Data yang dikirim:
-    - current_called: nomor & nama
-    - waiting: list nomor & nama
-    """
-    today = date.today()
 
-    current_called = (
-        Queue.query
-        .filter(
-            Queue.umkm_id == umkm.id,
-            Queue.status == "called",
-            db.func.date(Queue.created_at) == today
-        )
-        .order_by(Queue.called_at.desc())
-        .first()
+def display_playlist(umkm_id: int) -> list:
+    """Playlist kiosk urut tayang, satu query lewat ix_display_media_umkm_position."""
+    return (
+        DisplayMedia.query
+        .filter_by(umkm_id=umkm_id)
+        .order_by(DisplayMedia.position.asc(), DisplayMedia.id.asc())
+        .all()
     )
 
-    waiting_list = (
-        Queue.query
-        .filter(
-            Queue.umkm_id == umkm.id,
-            Queue.status == "waiting",
-            db.func.date(Queue.created_at) == today
-        )
-        .order_by(Queue.queue_number.asc())
-        .all()
+
+def add_display_media(umkm_id: int, kind: str, path: str, size: int = None,
+                      sha256: str = None) -> DisplayMedia:
+    """Tambah satu media di akhir playlist (belum commit)."""
+    last = (
+        db.session.query(db.func.max(DisplayMedia.position))
+        .filter(DisplayMedia.umkm_id == umkm_id)
+        .scalar()
     )
+    row = DisplayMedia(
+        umkm_id=umkm_id,
+        kind=kind,
+        path=path,
+        position=(last or 0) + DISPLAY_MEDIA_GAP,
+        size=size,
+        hash=sha256
+    )
+    db.session.add(row)
+    return row
 
-    data = {
-        "current_called": {
-            "number": current_called.queue_number,
-            "name": current_called.customer_name or "Tanpa nama"
-        } if current_called else None,
-        "waiting": [
-            {
-                "number": q.queue_number,
-                "name": q.customer_name or "Tanpa nama"
-            } for q in waiting_list
-        ]
-    }
 
-    # gunakan slug sebagai room
-    socketio.emit("queue_update", data, room=umkm.slug)
+def renumber_display_media(umkm_id: int):
+    """Beri jarak ulang semua position (hanya kalau jarak antar media sudah habis)."""
+    for i, row in enumerate(display_playlist(umkm_id), start=1):
+        row.position = i * DISPLAY_MEDIA_GAP
+    db.session.flush()
 
-@socketio.on("join_display")
-def handle_join_display(data):
+
+def move_display_media(row: DisplayMedia, step: int) -> bool:
     """
-    Dipanggil dari halaman display untuk bergabung ke 'room' UMKM tertentu.
-    Room yang dipakai: slug UMKM.
+    Geser media satu langkah (step -1 = naik, +1 = turun) dengan memberi position baru di
+    tengah dua tetangganya: cukup ubah baris ini saja. Return False kalau sudah di ujung.
     """
-    room = data.get("room")
-    if room:
-        join_room(room)
-
-def get_current_user():
-    """Return User object if logged in, else None."""
-    user_id = session.get("user_id")
-    if user_id:
-        return User.query.get(user_id)
-    return None
+    query = DisplayMedia.query.filter(DisplayMedia.umkm_id == row.umkm_id, DisplayMedia.id != row.id)
+    for _ in range(2):
+        if step < 0:
+            neighbors = (
+                query.filter(DisplayMedia.position <= row.position)
+                .order_by(DisplayMedia.position.desc(), DisplayMedia.id.desc())
+                .limit(2).all()
+            )
+        else:
+            neighbors = (
+                query.filter(DisplayMedia.position >= row.position)
+                .order_by(DisplayMedia.position.asc(), DisplayMedia.id.asc())
+                .limit(2).all()
+            )
+        if not neighbors:
+            return False
+
+        near = neighbors[0].position
+        far = neighbors[1].position if len(neighbors) > 1 else near + step * 2 * DISPLAY_MEDIA_GAP
+        new_position = (near + far) // 2
+        if near != row.position and new_position not in (near, far):
+            row.position = new_position
+            return True
+        # posisi kembar / jarak habis: beri jarak ulang lalu hitung sekali lagi
+        renumber_display_media(row.umkm_id)
+    return False
+
+
+def display_media_files(row: DisplayMedia) -> list:
+    """Semua file fisik milik satu media (gambar WebP punya beberapa varian lebar)."""
+    match = IMAGE_VARIANT_RE.match(row.path) if row.kind == "image" else None
+    if not match:
+        return [os.path.join("static", row.path)]
+    base = match.group(1)
+    widths = set(app.config["IMAGE_VARIANT_WIDTHS"]) | {int(match.group(2))}
+    return [os.path.join("static", f"{base}_{w}w.webp") for w in widths]
 
 
-def generate_next_queue_number(umkm_id: int) -> int:
-    """Ambil nomor antrian terakhir HARI INI untuk UMKM tersebut lalu +1."""
-    today = date.today()
-    last_queue = (
-        Queue.query
-        .filter(
-            Queue.umkm_id == umkm_id,
-            db.func.date(Queue.created_at) == today
-        )
-        .order_by(Queue.queue_number.desc())
-        .first()
-    )
-    return 1 if not last_queue else last_queue.queue_number + 1
+# --------------------------------------------------
+# MEDIA: UPLOAD VIDEO BERTAHAP (CHUNKED, BISA DILANJUTKAN)
+# --------------------------------------------------
+# Satu upload = <id>.part (isi file) + <id>.json (meta) di CHUNK_UPLOAD_FOLDER. Semua state ada
+# di disk, jadi upload bisa dilanjutkan setelah koneksi putus atau di worker lain.
+# - Potongan dikirim berurutan dengan ukuran tetap chunk_size (kecuali potongan terakhir),
+#   jadi panjang .part selalu kelipatan chunk_size dan offset lanjutan = panjang file.
+# - Tiap potongan boleh membawa header X-Chunk-Sha256; kalau tidak cocok, potongan dibuang.
+# - Checksum akhir = sha256 dari gabungan hex sha256 tiap potongan (bisa dihitung browser
+#   tanpa memuat seluruh video ke memori), dihitung ulang server dari file di disk.
 
+CHUNK_UPLOAD_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+CHUNK_UPLOAD_READ_BYTES = 64 * 1024
 
-def send_whatsapp_notification(number: str, message: str):
-    """
-    Fungsi integrasi WhatsApp ke API SUKIPLI.
-    Di sinilah request POST dikirim.
-    """
-    url = "https://wa.sukipli.work/send-message"
-    payload = {
-        "number": number,
-        "message": message
-    }
 
-    try:
-        r = requests.post(url, json=payload, timeout=10)
-        return r.status_code, r.text
-    except Exception as e:
-        # Jika error jaringan / timeout
-        return "error", str(e)
+def chunk_upload_paths(upload_id: str):
+    folder = app.config["CHUNK_UPLOAD_FOLDER"]
+    return os.path.join(folder, f"{upload_id}.part"), os.path.join(folder, f"{upload_id}.json")
 
 
-def generate_umkm_qr(umkm: UMKM):
-    """Generate QR code PNG file for the UMKM URL dan simpan di static/qr."""
-    qr_folder = os.path.join("static", "qr")
-    os.makedirs(qr_folder, exist_ok=True)
+def load_chunk_upload(upload_id: str, umkm: UMKM):
+    """Meta upload milik UMKM ini, atau None kalau tidak ada / bukan miliknya."""
+    if not CHUNK_UPLOAD_ID_RE.match(upload_id):
+        return None
+    part_path, meta_path = chunk_upload_paths(upload_id)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("umkm_id") != umkm.id or not os.path.exists(part_path):
+        return None
+    return meta
+
+
+def purge_stale_chunk_uploads():
+    """Hapus upload setengah jadi yang tidak disentuh lebih dari CHUNK_UPLOAD_TTL_HOURS."""
+    folder = app.config["CHUNK_UPLOAD_FOLDER"]
+    cutoff = time.time() - app.config["CHUNK_UPLOAD_TTL_HOURS"] * 3600
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
 
-    url = f"{request.url_root}{umkm.slug}"  # misal: http://localhost:5000/barbershop-andi
-    img = qrcode.make(url)
 
-    filename = f"{umkm.slug}.png"
-    path = os.path.join(qr_folder, filename)
-    img.save(path)
+def chunk_upload_offset(part_path: str, meta: dict) -> int:
+    """Offset lanjutan; sisa potongan yang terputus di tengah (proses mati) dibuang dulu."""
+    length = os.path.getsize(part_path)
+    aligned = length - length % meta["chunk_size"]
+    if length != meta["size"] and length != aligned:
+        with open(part_path, "r+b") as f:
+            f.truncate(aligned)
+        return aligned
+    return length
+
+
+def chunk_upload_checksums(part_path: str, chunk_size: int):
+    """Return (checksum daftar potongan, sha256 seluruh file), dibaca streaming dari disk."""
+    whole = hashlib.sha256()
+    chunk_hexes = []
+    with open(part_path, "rb") as f:
+        while True:
+            chunk_digest = hashlib.sha256()
+            remaining = chunk_size
+            while remaining:
+                block = f.read(min(CHUNK_UPLOAD_READ_BYTES, remaining))
+                if not block:
+                    break
+                chunk_digest.update(block)
+                whole.update(block)
+                remaining -= len(block)
+            if remaining == chunk_size:
+                break
+            chunk_hexes.append(chunk_digest.hexdigest())
+    return hashlib.sha256("".join(chunk_hexes).encode()).hexdigest(), whole.hexdigest()
 
-    umkm.qr_path = filename
-    db.session.commit()
-    return filename
 
+# --------------------------------------------------
+# MEDIA: URL BERBASIS HASH ISI FILE
+# --------------------------------------------------
+# File di static/upload disajikan lewat /media/<digest>/<path>, digest = 16 hex pertama sha256
+# isi file. Isi berubah → URL berubah, jadi browser kiosk boleh menyimpannya selamanya
+# (Cache-Control immutable) dan tidak perlu revalidasi setiap rotasi slide.
+# Digest di-cache per (path, mtime, ukuran) supaya file hanya di-hash sekali per proses.
 
-def send_auto_reminders(umkm: UMKM, base_url: str):
-    """
-    Kirim WA otomatis untuk antrian yang jaraknya <= 3 nomor lagi.
-    - Hanya untuk HARI INI.
-    - Hanya kirim sekali per antrian (cek di WALog dengan tag [AUTO_REMINDER]).
-    - Mengurangi kredit per pesan.
-    - base_url: request.url_root dari route pemanggil.
-    """
-    today = date.today()
-    base_url = base_url.rstrip("/")
+MEDIA_MAX_AGE = 365 * 24 * 3600
 
-    current_called = (
-        Queue.query
-        .filter(
-            Queue.umkm_id == umkm.id,
-            Queue.status == "called",
-            db.func.date(Queue.created_at) == today
-        )
-        .order_by(Queue.called_at.desc())
-        .first()
-    )
+media_digest_cache = LRUCache(app.config["MEDIA_DIGEST_CACHE_SIZE"])
 
-    if not current_called:
-        return
 
-    waiting_list = (
-        Queue.query
-        .filter(
-            Queue.umkm_id == umkm.id,
-            Queue.status == "waiting",
-            db.func.date(Queue.created_at) == today
-        )
-        .order_by(Queue.queue_number.asc())
-        .all()
-    )
+def media_abs_path(path: str):
+    """Path absolut file upload; None kalau di luar static/upload."""
+    if not (path or "").startswith("upload/"):
+        return None
+    return safe_join(os.path.abspath("static"), path)
 
-    for q in waiting_list:
-        if not q.customer_phone:
-            continue
 
-        ahead = q.queue_number - current_called.queue_number - 1
-        if ahead < 0 or ahead > 2:
-            continue
+def file_sha256(abs_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(abs_path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK_UPLOAD_READ_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
-        already = WALog.query.filter(
-            WALog.queue_id == q.id,
-            WALog.message.like("%[AUTO_REMINDER]%")
-        ).first()
 
-        if already:
-            continue
+def media_digest_key(abs_path: str):
+    st = os.stat(abs_path)
+    return abs_path, st.st_mtime_ns, st.st_size
 
-        if umkm.credit_balance <= 0:
-            break
 
-        if ahead <= 0:
-            status_text = "giliran Anda hampir tiba (berikutnya)."
-        else:
-            status_text = f"tinggal {ahead} orang di depan Anda."
+def media_digest(path: str):
+    """Hash isi file upload (dari cache kalau ada). None kalau file tidak ada."""
+    abs_path = media_abs_path(path)
+    if not abs_path:
+        return None
+    try:
+        key = media_digest_key(abs_path)
+    except OSError:
+        return None
 
-        ticket_url = f"{base_url}/{umkm.slug}?ticket_id={q.id}"
+    digest = media_digest_cache.get(key)
+    if digest is None:
+        # hash yang tersimpan saat upload dipakai dulu, file besar tidak perlu di-hash ulang
+        stored = db.session.query(DisplayMedia.hash).filter_by(path=path).limit(1).scalar()
+        digest = (stored or run_blocking(file_sha256, abs_path))[:16]
+        media_digest_cache.set(key, digest)
+    return digest
 
-        msg = (
-            f"[AUTO_REMINDER] Halo {q.customer_name or 'Pelanggan'}, ini dari {umkm.name}. "
-            f"Antrian Anda #{q.queue_number} {status_text} "
-            f"Cek status antrian di sini: {ticket_url}"
-        )
 
-        status, raw = send_whatsapp_notification(q.customer_phone, msg)
+def remember_media_digest(path: str, sha256: str):
+    """Isi cache digest dari hash yang sudah dihitung saat upload (video besar tidak di-hash ulang)."""
+    abs_path = media_abs_path(path)
+    if abs_path:
+        media_digest_cache.set(media_digest_key(abs_path), sha256[:16])
 
-        walog = WALog(
-            umkm_id=umkm.id,
-            queue_id=q.id,
-            phone_number=q.customer_phone,
-            message=msg,
-            status=str(status),
-            response_raw=str(raw)
-        )
-        db.session.add(walog)
-
-        if status == 200:
-            umkm.credit_balance -= 1
-            db.session.add(CreditLog(
-                umkm_id=umkm.id,
-                change=-1,
-                description=f"Auto reminder ke #{q.queue_number}"
-            ))
 
-        db.session.commit()
+def media_url(path: str, sha256: str = None) -> str:
+    """
+    URL permanen untuk file upload; file yang tidak ditemukan jatuh ke URL static biasa.
+    sha256 diisi (misal DisplayMedia.hash) = tidak perlu stat/hash file.
+    """
+    digest = sha256[:16] if sha256 else media_digest(path)
+    if not digest:
+        return url_for("static", filename=path)
+    return url_for("media_file", digest=digest, path=path)
 
 
 # --------------------------------------------------
@@ -387,6 +2325,25 @@ def offline():
     return render_template("offline.html")
 
 
+@app.route("/media/<digest>/<path:path>")
+def media_file(digest, path):
+    """
+    File upload dengan cache permanen: ETag kuat = digest, Range (206) untuk seek video,
+    sendfile lewat wsgi.file_wrapper / X-Sendfile kalau tersedia.
+    """
+    current = media_digest(path)
+    if current is None:
+        abort(404)
+    if digest != current:
+        # file sudah diganti: arahkan ke URL terbaru, redirect ini tidak di-cache permanen
+        return redirect(media_url(path))
+
+    response = send_file(media_abs_path(path), conditional=True, etag=current, max_age=MEDIA_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
 # --------------------------------------------------
 # ROUTES: AUTH
 # --------------------------------------------------
@@ -427,13 +2384,7 @@ def register():
         db.session.add(umkm)
         db.session.commit()
 
-        # auto generate QR pertama kali
-        try:
-            generate_umkm_qr(umkm)
-        except Exception:
-            # kalau gagal generate QR, tidak perlu blok registrasi
-            pass
-
+        # QR tidak perlu dibuat di sini, dirender saat diminta lewat /qr/<slug>.png
         flash("Registrasi berhasil, silakan login!", "success")
         return redirect(url_for("login"))
 
@@ -452,7 +2403,7 @@ def login():
             flash("Email atau password salah.", "danger")
             return redirect(url_for("login"))
 
-        session["user_id"] = user.id
+        login_session(user, user.umkm)
         return redirect(url_for("dashboard"))
 
     return render_template("auth_login.html")
@@ -475,38 +2426,7 @@ def contact():
 @app.route("/<slug_umkm>")
 def queue_public(slug_umkm):
     umkm = UMKM.query.filter_by(slug=slug_umkm).first_or_404()
-    today = date.today()
-
-    current_called = (
-        Queue.query
-        .filter(
-            Queue.umkm_id == umkm.id,
-            Queue.status == "called",
-            db.func.date(Queue.created_at) == today
-        )
-        .order_by(Queue.called_at.desc())
-        .first()
-    )
-
-    waiting_list = (
-        Queue.query
-        .filter(
-            Queue.umkm_id == umkm.id,
-            Queue.status == "waiting",
-            db.func.date(Queue.created_at) == today
-        )
-        .order_by(Queue.queue_number.asc())
-        .all()
-    )
-
-    count_today = (
-        Queue.query
-        .filter(
-            Queue.umkm_id == umkm.id,
-            db.func.date(Queue.created_at) == today
-        )
-        .count()
-    )
+    snapshot = get_queue_snapshot(umkm)
 
     ticket_id = request.args.get("ticket_id", type=int)
     new_ticket = None
@@ -516,13 +2436,22 @@ def queue_public(slug_umkm):
             umkm_id=umkm.id
         ).first()
 
+    # perkiraan menit sampai tiket ini dipanggil (kalau masih waiting & estimasi sudah ada)
+    ticket_eta = None
+    if new_ticket and new_ticket.status == "waiting":
+        for entry, eta in zip(snapshot["waiting"], waiting_eta_seconds(snapshot)):
+            if entry.id == new_ticket.id:
+                ticket_eta = eta_minutes(eta)
+                break
+
     return render_template(
         "queue_public.html",
         umkm=umkm,
-        current_called=current_called,
-        waiting=waiting_list,
-        count_today=count_today,
-        new_ticket=new_ticket
+        current_called=snapshot["current_called"],
+        waiting=snapshot["waiting"],
+        count_today=snapshot["count_today"],
+        new_ticket=new_ticket,
+        ticket_eta=ticket_eta
     )
 
 
@@ -533,20 +2462,27 @@ def take_queue(slug_umkm):
     name = request.form.get("customer_name")
     phone = request.form.get("customer_phone")
 
-    next_num = generate_next_queue_number(umkm.id)
+    # nomor & tiket dibuat dalam satu transaksi
+    today = date.today()
+    next_num = allocate_queue_number(umkm.id, today)
 
     q = Queue(
         umkm_id=umkm.id,
+        service_date=today,
         queue_number=next_num,
         customer_name=name,
         customer_phone=phone,
         status="waiting"
     )
     db.session.add(q)
-    db.session.commit()
+    version = bump_queue_version(umkm.id)
+    db.session.flush()
+    record_ticket_stats(q)
 
     # WA KONFIRMASI: kirim sekali saat ambil nomor (jika ada nomor WA & ada kredit)
-    if phone and umkm.credit_balance > 0:
+    # pesan masuk outbox di transaksi yang sama dengan tiket, dikirim worker di background
+    queued_wa = False
+    if phone:
         base_url = request.url_root.rstrip("/")
         ticket_url = f"{base_url}/{umkm.slug}?ticket_id={q.id}"
 
@@ -557,29 +2493,19 @@ def take_queue(slug_umkm):
             f"Cek status antrian Anda di sini: {ticket_url}\n"
         )
 
-        status, raw = send_whatsapp_notification(phone, msg)
-
-        walog = WALog(
+        # kredit habis → enqueue_whatsapp return None, tiket tetap dibuat tanpa WA
+        queued_wa = enqueue_whatsapp(
+            phone, msg, "NEW_TICKET",
             umkm_id=umkm.id,
             queue_id=q.id,
-            phone_number=phone,
-            message=msg,
-            status=str(status),
-            response_raw=str(raw)
-        )
-        db.session.add(walog)
-
-        if status == 200:
-            umkm.credit_balance -= 1
-            db.session.add(CreditLog(
-                umkm_id=umkm.id,
-                change=-1,
-                description=f"Konfirmasi tiket #{q.queue_number}"
-            ))
+            credit_description=f"Konfirmasi tiket #{next_num}"
+        ) is not None
 
-        db.session.commit()
+    db.session.commit()
+    if queued_wa:
+        wake_wa_outbox()
 
-    broadcast_queue_update(umkm)
+    broadcast_queue_delta(umkm, version, [("added", queue_entry(q))])
 
     flash(f"Nomor antrian Anda: {next_num}", "success")
 
@@ -588,72 +2514,94 @@ def take_queue(slug_umkm):
     )
 
 # --------------------------------------------------
-# ROUTES: DASHBOARD OWNER
+# ROUTES: API STATUS ANTRIAN (JSON)
 # --------------------------------------------------
 
-@app.route("/dashboard")
-def dashboard():
-    user = get_current_user()
-    if not user:
-        return redirect(url_for("login"))
+def queue_state_etag(umkm: UMKM, day: date = None) -> str:
+    """
+    ETag state antrian: versi + hari layanan. Lewat tengah malam snapshot dibangun untuk hari baru
+    walau queue_version belum berubah, jadi ETag kemarin tidak boleh ikut cocok (→ 304 basi).
+    """
+    day = day or date.today()
+    return f"q{umkm.id}-{day:%Y%m%d}-v{umkm.queue_version or 0}"
+
 
-    umkm = user.umkm
+@app.route("/api/<slug>/state")
+def api_queue_state(slug):
+    """
+    Snapshot antrian (format sama dengan event queue_update) untuk client tanpa websocket.
+    - ETag (weak) dari versi antrian & hari layanan: If-None-Match yang masih cocok → 304 tanpa body.
+    - ?wait=N (detik, maks API_STATE_MAX_WAIT_SECONDS): kalau versinya belum berubah, tahan
+      request sampai ada perubahan (dibangunkan QueueVersionNotifier) atau waktu habis (→ 304).
+      Versi dicek ulang ke DB tiap API_STATE_POLL_SECONDS untuk perubahan dari worker lain.
+    Koneksi DB dilepas selama menunggu.
+    """
+    wait = request.args.get("wait", 0, type=float)
+    if not math.isfinite(wait):
+        # NaN lolos dari min/max dan membuat loop di bawah tidak pernah selesai
+        return jsonify({"error": "Parameter wait tidak valid."}), 400
+    wait = min(max(wait, 0), app.config["API_STATE_MAX_WAIT_SECONDS"])
+    deadline = time.monotonic() + wait
+
+    umkm = UMKM.query.filter_by(slug=slug).first()
     if not umkm:
-        flash("UMKM belum terhubung dengan akun ini.", "danger")
-        return redirect(url_for("index"))
+        return jsonify({"error": "UMKM tidak ditemukan."}), 404
+    umkm_id = umkm.id
+    event = None
+
+    while request.if_none_match.contains_weak(queue_state_etag(umkm)):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            response = app.response_class(status=304)
+            response.set_etag(queue_state_etag(umkm), weak=True)
+            return response
+
+        if event is None:
+            if app.config["SOCKETIO_BACKEND"] == "postgres":
+                # pastikan worker ini menerima NOTIFY UMKM ini walau tidak ada client websocket di sini
+                pg_fanout.subscribe(umkm_id, umkm.slug)
+            # ambil event dulu, baru baca ulang versinya: perubahan sesudah titik ini pasti membangunkan
+            event = queue_version_notifier.event_for(umkm_id)
+        else:
+            db.session.close()  # jangan tahan koneksi DB selama menunggu
+            event.wait(min(remaining, app.config["API_STATE_POLL_SECONDS"]))
+            event = None
 
-    today = date.today()
+        umkm = db.session.get(UMKM, umkm_id, populate_existing=True)
+        if not umkm:
+            return jsonify({"error": "UMKM tidak ditemukan."}), 404
 
-    waiting = (
-        Queue.query
-        .filter(
-            Queue.umkm_id == umkm.id,
-            Queue.status == "waiting",
-            db.func.date(Queue.created_at) == today
-        )
-        .order_by(Queue.queue_number.asc())
-        .all()
-    )
+    snapshot = get_queue_snapshot(umkm)
+    response = jsonify(queue_snapshot_payload(snapshot))
+    response.set_etag(queue_state_etag(umkm, snapshot["service_date"]), weak=True)
+    response.cache_control.no_cache = True
+    return response
 
-    current_called = (
-        Queue.query
-        .filter(
-            Queue.umkm_id == umkm.id,
-            Queue.status == "called",
-            db.func.date(Queue.created_at) == today
-        )
-        .order_by(Queue.called_at.desc())
-        .first()
-    )
 
-    count_today = (
-        Queue.query
-        .filter(
-            Queue.umkm_id == umkm.id,
-            db.func.date(Queue.created_at) == today
-        )
-        .count()
-    )
+# --------------------------------------------------
+# ROUTES: DASHBOARD OWNER
+# --------------------------------------------------
 
-    history = (
-        Queue.query
-        .filter(
-            Queue.umkm_id == umkm.id,
-            Queue.status.in_(["done", "canceled", "no_show"]),
-            db.func.date(Queue.created_at) == today
-        )
-        .order_by(Queue.queue_number.asc())
-        .all()
-    )
+@app.route("/dashboard")
+def dashboard():
+    if not current_identity():
+        return redirect(url_for("login"))
+
+    umkm = get_current_umkm()
+    if not umkm:
+        flash("UMKM belum terhubung dengan akun ini.", "danger")
+        return redirect(url_for("index"))
 
+    # current/waiting/histori/total dari satu snapshot (maksimal satu query)
+    snapshot = get_queue_snapshot(umkm)
 
     return render_template(
         "dashboard_owner.html",
         umkm=umkm,
-        waiting=waiting,
-        current_called=current_called,
-        count_today=count_today,
-        history=history
+        waiting=snapshot["waiting"],
+        current_called=snapshot["current_called"],
+        count_today=snapshot["count_today"],
+        history=snapshot["history"]
     )
 
 
@@ -665,11 +2613,13 @@ def queue_next():
     - Lalu panggil nomor waiting berikutnya (kalau ada).
     - Setelah itu jalankan auto reminder (kurang 3 nomor lagi).
     """
-    user = get_current_user()
-    if not user:
+    if not current_identity():
         return redirect(url_for("login"))
 
-    umkm = user.umkm
+    umkm = get_current_umkm_cached()
+    if not umkm:
+        flash("UMKM belum terhubung dengan akun ini.", "danger")
+        return redirect(url_for("index"))
     today = date.today()
 
     # 1. Tandai nomor yang sedang dipanggil sebagai selesai (done)
@@ -678,15 +2628,17 @@ def queue_next():
         .filter(
             Queue.umkm_id == umkm.id,
             Queue.status == "called",
-            db.func.date(Queue.created_at) == today
+            Queue.service_date == today
         )
         .first()
     )
 
     if active_called:
+        before = ticket_stats(active_called)
         active_called.status = "done"
         active_called.finished_at = datetime.now()
-        db.session.commit()
+        record_ticket_stats(active_called, before)
+        observe_service_time(active_called)
 
     # 2. Ambil antrian waiting paling awal
     waiting = (
@@ -694,7 +2646,7 @@ def queue_next():
         .filter(
             Queue.umkm_id == umkm.id,
             Queue.status == "waiting",
-            db.func.date(Queue.created_at) == today
+            Queue.service_date == today
         )
         .order_by(Queue.queue_number.asc())
         .first()
@@ -703,12 +2655,23 @@ def queue_next():
     if waiting:
         waiting.status = "called"
         waiting.called_at = datetime.now()
+
+    # selesai + panggil berikutnya dalam satu commit
+    ops = []
+    if active_called:
+        ops.append(("removed", queue_entry(active_called)))
+    if waiting:
+        ops.append(("called", queue_entry(waiting)))
+    if ops:
+        version = bump_queue_version(umkm.id)
         db.session.commit()
+        broadcast_queue_delta(umkm, version, ops)
 
+    if waiting:
         flash(f"Memanggil nomor {waiting.queue_number}", "success")
 
         # 3. Auto reminder ke antrian yang sudah dekat
-        send_auto_reminders(umkm, request.url_root)
+        send_auto_reminders(umkm, request.url_root, waiting.queue_number)
     else:
         # Tidak ada waiting, hanya menyelesaikan yang aktif
         if active_called:
@@ -716,8 +2679,6 @@ def queue_next():
         else:
             flash("Tidak ada antrian aktif.", "info")
 
-    broadcast_queue_update(umkm)
-
     return redirect(url_for("dashboard"))
 
 @app.route("/dashboard/queue/skip", methods=["POST"])
@@ -728,11 +2689,13 @@ def queue_skip():
     - Lalu panggil waiting berikutnya.
     - Auto reminder tetap dijalankan.
     """
-    user = get_current_user()
-    if not user:
+    if not current_identity():
         return redirect(url_for("login"))
 
-    umkm = user.umkm
+    umkm = get_current_umkm_cached()
+    if not umkm:
+        flash("UMKM belum terhubung dengan akun ini.", "danger")
+        return redirect(url_for("index"))
     today = date.today()
 
     # 1. Tandai nomor aktif sebagai no_show
@@ -741,15 +2704,16 @@ def queue_skip():
         .filter(
             Queue.umkm_id == umkm.id,
             Queue.status == "called",
-            db.func.date(Queue.created_at) == today
+            Queue.service_date == today
         )
         .first()
     )
 
     if active_called:
+        before = ticket_stats(active_called)
         active_called.status = "no_show"
         active_called.finished_at = datetime.now()
-        db.session.commit()
+        record_ticket_stats(active_called, before)
     else:
         flash("Tidak ada nomor yang sedang dipanggil.", "info")
 
@@ -759,7 +2723,7 @@ def queue_skip():
         .filter(
             Queue.umkm_id == umkm.id,
             Queue.status == "waiting",
-            db.func.date(Queue.created_at) == today
+            Queue.service_date == today
         )
         .order_by(Queue.queue_number.asc())
         .first()
@@ -768,54 +2732,87 @@ def queue_skip():
     if waiting:
         waiting.status = "called"
         waiting.called_at = datetime.now()
+
+    ops = []
+    if active_called:
+        ops.append(("removed", queue_entry(active_called)))
+    if waiting:
+        ops.append(("called", queue_entry(waiting)))
+    if ops:
+        version = bump_queue_version(umkm.id)
         db.session.commit()
+        broadcast_queue_delta(umkm, version, ops)
+
+    if waiting:
         flash(f"Melewati nomor sebelumnya. Memanggil nomor {waiting.queue_number}.", "info")
 
-        send_auto_reminders(umkm, request.url_root)
+        send_auto_reminders(umkm, request.url_root, waiting.queue_number)
     else:
         flash("Tidak ada antrian menunggu.", "info")
 
-    broadcast_queue_update(umkm)
-
     return redirect(url_for("dashboard"))
 
 
 @app.route("/dashboard/queue/finish/<int:queue_id>", methods=["POST"])
 def queue_finish(queue_id):
-    user = get_current_user()
-    if not user:
+    if not current_identity():
         return redirect(url_for("login"))
 
-    umkm = user.umkm
+    umkm = get_current_umkm_cached()
+    if not umkm:
+        flash("UMKM belum terhubung dengan akun ini.", "danger")
+        return redirect(url_for("index"))
     q = Queue.query.get_or_404(queue_id)
     if q.umkm_id != umkm.id:
         abort(404)
+    # hanya tiket yang masih terbuka hari ini; tiket selesai/batal/hari lain tidak diubah lagi
+    if not is_open_today(q):
+        flash(f"Nomor {q.queue_number} sudah tidak aktif.", "info")
+        return redirect(url_for("dashboard"))
 
+    before = ticket_stats(q)
+    was_called = q.status == "called"
     q.status = "done"
     q.finished_at = datetime.now()
+    record_ticket_stats(q, before)
+    if was_called:
+        observe_service_time(q)
+    entry = queue_entry(q)
+    version = bump_queue_version(umkm.id)
     db.session.commit()
 
     flash(f"Nomor {q.queue_number} diselesaikan.", "success")
+    broadcast_queue_delta(umkm, version, [("removed", entry)])
     return redirect(url_for("dashboard"))
 
 
 @app.route("/dashboard/queue/cancel/<int:queue_id>", methods=["POST"])
 def queue_cancel(queue_id):
-    user = get_current_user()
-    if not user:
+    if not current_identity():
         return redirect(url_for("login"))
 
-    umkm = user.umkm
+    umkm = get_current_umkm_cached()
+    if not umkm:
+        flash("UMKM belum terhubung dengan akun ini.", "danger")
+        return redirect(url_for("index"))
     q = Queue.query.get_or_404(queue_id)
     if q.umkm_id != umkm.id:
         abort(404)
+    # hanya tiket yang masih terbuka hari ini; tiket selesai/batal/hari lain tidak diubah lagi
+    if not is_open_today(q):
+        flash(f"Nomor {q.queue_number} sudah tidak aktif.", "info")
+        return redirect(url_for("dashboard"))
 
+    before = ticket_stats(q)
     q.status = "canceled"
     q.canceled_at = datetime.now()
+    record_ticket_stats(q, before)
+    entry = queue_entry(q)
+    version = bump_queue_version(umkm.id)
     db.session.commit()
 
     flash(f"Nomor {q.queue_number} dibatalkan.", "success")
-    broadcast_queue_update(umkm)
+    broadcast_queue_delta(umkm, version, [("removed", entry)])
     return redirect(url_for("dashboard"))
 
 
@@ -825,19 +2822,17 @@ def queue_cancel(queue_id):
 
 @app.route("/dashboard/wa/send/<int:queue_id>", methods=["POST"])
 def send_wa(queue_id):
-    user = get_current_user()
-    if not user:
+    if not current_identity():
         return redirect(url_for("login"))
 
-    umkm = user.umkm
+    umkm = get_current_umkm_cached()
+    if not umkm:
+        flash("UMKM belum terhubung dengan akun ini.", "danger")
+        return redirect(url_for("index"))
     q = Queue.query.get_or_404(queue_id)
     if q.umkm_id != umkm.id:
         abort(404)
 
-    if umkm.credit_balance <= 0:
-        flash("Kredit tidak cukup!", "danger")
-        return redirect(url_for("dashboard"))
-
     if not q.customer_phone:
         flash("Nomor pelanggan tidak tersedia.", "danger")
         return redirect(url_for("dashboard"))
@@ -851,40 +2846,29 @@ def send_wa(queue_id):
         f"Cek status antrian di sini: {ticket_url}"
     )
 
-    status, raw = send_whatsapp_notification(q.customer_phone, msg)
-
-    walog = WALog(
+    row = enqueue_whatsapp(
+        q.customer_phone, msg, "MANUAL",
         umkm_id=umkm.id,
         queue_id=q.id,
-        phone_number=q.customer_phone,
-        message=msg,
-        status=str(status),
-        response_raw=str(raw)
+        credit_description=f"Kirim WA manual ke #{q.queue_number}"
     )
-    db.session.add(walog)
-
-    if status == 200:
-        umkm.credit_balance -= 1
-        db.session.add(CreditLog(
-            umkm_id=umkm.id,
-            change=-1,
-            description=f"Kirim WA manual ke #{q.queue_number}"
-        ))
-        db.session.commit()
-        flash("Pesan WA berhasil dikirim!", "success")
-    else:
-        db.session.commit()
-        flash("Gagal mengirim WA. Kredit tidak dipotong.", "danger")
+    if row is None:
+        flash("Kredit tidak cukup!", "danger")
+        return redirect(url_for("dashboard"))
+    db.session.commit()
+    wake_wa_outbox()
 
+    flash("Pesan WA sedang dikirim. Kredit hanya dipotong jika terkirim.", "success")
     return redirect(url_for("dashboard"))
- 
+
+
 @app.route("/dashboard/topup/start", methods=["POST"])
 def start_topup():
-    user = get_current_user()
-    if not user:
+    identity = current_identity()
+    if not identity:
         return redirect(url_for("login"))
 
-    umkm = user.umkm
+    umkm = get_current_umkm()
     if not umkm:
         flash("UMKM tidak ditemukan.", "danger")
         return redirect(url_for("dashboard_settings"))
@@ -916,7 +2900,7 @@ def start_topup():
 
     tx = TopupTransaction(
         umkm_id=umkm.id,
-        user_id=user.id,
+        user_id=identity.user_id,
         package_name=package_name,
         credits=credits,
         amount=amount,
@@ -932,11 +2916,10 @@ def start_topup():
 
 @app.route("/dashboard/topup/<int:tx_id>/confirm", methods=["GET", "POST"])
 def topup_confirm(tx_id):
-    user = get_current_user()
-    if not user:
+    if not current_identity():
         return redirect(url_for("login"))
 
-    umkm = user.umkm
+    umkm = get_current_umkm()
     if not umkm:
         flash("UMKM tidak ditemukan.", "danger")
         return redirect(url_for("dashboard_settings"))
@@ -953,21 +2936,29 @@ def topup_confirm(tx_id):
             tx.note = note
 
         # Upload bukti transfer (gambar)
+        # diproses (WebP, tanpa EXIF) SEBELUM status & WA ke admin, supaya admin tidak pernah
+        # melihat transaksi "waiting_admin" yang buktinya belum ada / gagal diproses
         file = request.files.get("proof_image")
         if file and file.filename:
-            if allowed_file(file.filename, ALLOWED_IMAGE_EXT):
-                upload_dir = os.path.join(app.config["UPLOAD_FOLDER"], umkm.slug, "topup")
-                os.makedirs(upload_dir, exist_ok=True)
-                ts = datetime.now().strftime("%Y%m%d%H%M%S")
-                filename = secure_filename(f"topup_{tx.id}_{ts}_{file.filename}")
-                filepath = os.path.join(upload_dir, filename)
-                file.save(filepath)
-                rel_path = os.path.relpath(filepath, "static").replace("\\", "/")
-                tx.proof_image = rel_path
-            else:
+            if not allowed_file(file.filename, ALLOWED_IMAGE_EXT):
                 flash("Format bukti transfer tidak didukung. Gunakan gambar (jpg/png/jpeg/webp).", "danger")
                 return redirect(url_for("topup_confirm", tx_id=tx.id))
 
+            upload_dir = os.path.join(app.config["UPLOAD_FOLDER"], umkm.slug, "topup")
+            tmp_path = save_upload_tmp(file, upload_dir)
+            rel_base = upload_rel_base(umkm, f"topup_{tx.id}_{file.filename}", "topup")
+            try:
+                out_path = run_blocking(
+                    encode_webp_variants, tmp_path, os.path.join("static", rel_base),
+                    (max(app.config["IMAGE_VARIANT_WIDTHS"]),)
+                )
+            except Exception:
+                db.session.rollback()
+                app.logger.exception("Gagal memproses bukti transfer top-up #%s", tx.id)
+                flash("Bukti transfer tidak bisa diproses. Pastikan file berupa gambar yang valid, lalu kirim ulang.", "danger")
+                return redirect(url_for("topup_confirm", tx_id=tx.id))
+            tx.proof_image = os.path.relpath(out_path, "static").replace("\\", "/")
+
         # Set status menunggu admin, JANGAN langsung tambah kredit di sini
         if tx.status not in ("waiting_admin", "success"):
             tx.status = "waiting_admin"
@@ -994,9 +2985,12 @@ def topup_confirm(tx_id):
             admin_link = request.url_root.rstrip("/") + url_for("admin_topup_list")
             admin_message += f"\nID Transaksi: {tx.id}\nPanel Admin: {admin_link}"
 
-            send_whatsapp_notification(admin_number, admin_message)
+            enqueue_whatsapp(admin_number, admin_message, "TOPUP", umkm_id=umkm.id)
+            db.session.commit()
+            wake_wa_outbox()
         except Exception as e:
             # jangan gagalkan flow kalau WA ke admin gagal
+            db.session.rollback()
             print("Error send WA to admin:", e)
 
         flash("Terima kasih! Konfirmasi top-up terkirim dan menunggu ACC admin.", "success")
@@ -1011,11 +3005,10 @@ def topup_credit():
     MVP: top up kredit manual dari form.
     (Di production nanti bisa diganti integrasi pembayaran.)
     """
-    user = get_current_user()
-    if not user:
+    if not current_identity():
         return redirect(url_for("login"))
 
-    umkm = user.umkm
+    umkm = get_current_umkm()
     amount_raw = request.form.get("amount", "0")
 
     try:
@@ -1028,22 +3021,86 @@ def topup_credit():
         flash("Jumlah top-up harus lebih dari 0.", "danger")
         return redirect(url_for("dashboard_settings"))
 
-    umkm.credit_balance += amount
-    db.session.add(CreditLog(
-        umkm_id=umkm.id,
-        change=amount,
-        description=f"Top-up manual +{amount}"
-    ))
+    credit_add(umkm.id, amount, f"Top-up manual +{amount}")
     db.session.commit()
 
     flash(f"Top-up {amount} kredit berhasil.", "success")
     return redirect(url_for("dashboard_settings"))
 
+ADMIN_TOPUP_STATUSES = ("waiting_admin", "pending", "success", "rejected")
+ADMIN_TOPUP_PAGE_SIZE = 50
+
+
 @app.route("/admin/topup")
 def admin_topup_list():
+    """
+    Daftar top-up per status (default: menunggu ACC admin), terbaru dulu, 50 per halaman.
+    Halaman berikutnya pakai keyset ?after=<created_at>_<id> (baris terakhir halaman ini),
+    bukan OFFSET, jadi tetap cepat walau transaksinya puluhan ribu.
+    """
     # TODO: tambahkan proteksi admin beneran di production
-    txs = TopupTransaction.query.order_by(TopupTransaction.created_at.desc()).all()
-    return render_template("admin_topup.html", txs=txs)
+    status = request.args.get("status", "waiting_admin")
+    if status not in ADMIN_TOPUP_STATUSES and status != "all":
+        status = "waiting_admin"
+
+    query = TopupTransaction.query.options(
+        db.joinedload(TopupTransaction.umkm),
+        db.joinedload(TopupTransaction.user)
+    )
+    if status != "all":
+        query = query.filter(TopupTransaction.status == status)
+
+    after = request.args.get("after", "")
+    after_at, _, after_id = after.rpartition("_")
+    if after_at and after_id.isdigit():
+        try:
+            query = query.filter(
+                db.tuple_(TopupTransaction.created_at, TopupTransaction.id)
+                < (datetime.fromisoformat(after_at), int(after_id))
+            )
+        except ValueError:
+            abort(400)
+
+    txs = (
+        query
+        .order_by(TopupTransaction.created_at.desc(), TopupTransaction.id.desc())
+        .limit(ADMIN_TOPUP_PAGE_SIZE + 1)
+        .all()
+    )
+    next_after = None
+    if len(txs) > ADMIN_TOPUP_PAGE_SIZE:
+        txs = txs[:ADMIN_TOPUP_PAGE_SIZE]
+        next_after = f"{txs[-1].created_at.isoformat()}_{txs[-1].id}"
+
+    return render_template(
+        "admin_topup.html",
+        txs=txs,
+        status=status,
+        statuses=ADMIN_TOPUP_STATUSES,
+        next_after=next_after,
+        is_first_page=not after
+    )
+
+
+@app.route("/admin/metrics")
+def admin_metrics():
+    """Counter internal (JSON). Wajib token ADMIN_METRICS_TOKEN; tanpa konfigurasi token → 404."""
+    token = app.config["ADMIN_METRICS_TOKEN"]
+    if not token:
+        abort(404)
+    auth = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(auth.encode(), f"Bearer {token}".encode()):
+        abort(403)
+
+    return jsonify({
+        "wa_gateway": wa_gateway.stats(),
+        "queue_snapshot_cache": {
+            "size": len(queue_snapshot_cache),
+            "hits": queue_snapshot_cache.hits,
+            "misses": queue_snapshot_cache.misses,
+        },
+        "broadcast": dict(queue_broadcaster.counters),
+    })
 
 
 @app.route("/admin/topup/<int:tx_id>/approve", methods=["POST"])
@@ -1052,24 +3109,21 @@ def admin_topup_approve(tx_id):
     tx = TopupTransaction.query.get_or_404(tx_id)
     umkm = tx.umkm
 
-    if tx.status == "success":
+    # Tandai sebagai berhasil dengan UPDATE bersyarat: klik ACC dua kali (atau dua admin
+    # bersamaan) hanya menambah kredit sekali
+    approved = db.session.execute(
+        db.update(TopupTransaction)
+        .where(TopupTransaction.id == tx.id, TopupTransaction.status != "success")
+        .values(status="success", confirmed_at=datetime.now())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not approved:
+        db.session.rollback()
         flash("Transaksi ini sudah ditandai berhasil sebelumnya.", "info")
         return redirect(url_for("admin_topup_list"))
 
-    # Tandai sebagai berhasil
-    tx.status = "success"
-    tx.confirmed_at = datetime.now()
-
-    # Tambah kredit ke UMKM
-    umkm.credit_balance += tx.credits
-
-    # Catat di CreditLog
-    log = CreditLog(
-        umkm_id=umkm.id,
-        change=tx.credits,
-        description=f"Top-up paket {tx.package_name} (ACC admin)."
-    )
-    db.session.add(log)
+    # Tambah kredit ke UMKM + catat di CreditLog
+    balance = credit_add(umkm.id, tx.credits, f"Top-up paket {tx.package_name} (ACC admin).")
     db.session.commit()
 
     # ✅ Kirim WA ke pemilik UMKM (kalau ada nomor)
@@ -1081,11 +3135,14 @@ def admin_topup_approve(tx_id):
                 f"UMKM: {umkm.name}\n"
                 f"Paket: {tx.package_name}\n"
                 f"Kredit: {tx.credits}\n"
-                f"Saldo kredit saat ini: {umkm.credit_balance}.\n\n"
+                f"Saldo kredit saat ini: {balance}.\n\n"
                 f"Terima kasih, top-up Anda sudah kami proses. 🙏"
             )
-            send_whatsapp_notification(owner_number, message)
+            enqueue_whatsapp(owner_number, message, "TOPUP", umkm_id=umkm.id)
+            db.session.commit()
+            wake_wa_outbox()
     except Exception as e:
+        db.session.rollback()
         print("Error send WA to UMKM owner:", e)
 
     flash("Transaksi disetujui dan kredit berhasil ditambahkan.", "success")
@@ -1098,59 +3155,57 @@ def admin_topup_approve(tx_id):
 
 @app.route("/dashboard/stats")
 def dashboard_stats():
-    user = get_current_user()
-    if not user:
+    if not current_identity():
         return redirect(url_for("login"))
 
-    umkm = user.umkm
+    umkm = get_current_umkm_cached()
+    if not umkm:
+        flash("UMKM belum terhubung dengan akun ini.", "danger")
+        return redirect(url_for("index"))
 
-    # query parameter day=YYYY-MM-DD (optional)
-    day_str = request.args.get("day")
-    if day_str:
+    # query parameter start/end=YYYY-MM-DD (optional), day= untuk satu hari saja
+    def parse_day(value, default):
         try:
-            target_day = datetime.strptime(day_str, "%Y-%m-%d").date()
+            return datetime.strptime(value, "%Y-%m-%d").date() if value else default
         except ValueError:
-            target_day = date.today()
-    else:
-        target_day = date.today()
+            return default
 
-    stats = (
-        db.session.query(
-            db.func.date_trunc("hour", Queue.created_at).label("hour"),
-            db.func.count(Queue.id)
-        )
-        .filter(
-            Queue.umkm_id == umkm.id,
-            db.func.date(Queue.created_at) == target_day
-        )
-        .group_by("hour")
-        .order_by("hour")
-        .all()
-    )
+    today = date.today()
+    start_day = parse_day(request.args.get("start") or request.args.get("day"), today)
+    end_day = parse_day(request.args.get("end") or request.args.get("day"), start_day)
+    if end_day < start_day:
+        start_day, end_day = end_day, start_day
+
+    # satu hari → grafik per jam, rentang → grafik per hari (dijumlah di SQL)
+    single_day = start_day == end_day
+    rows = queue_stats_range(umkm.id, start_day, end_day, by_day=not single_day)
+
+    totals = dict.fromkeys(QUEUE_STATS_FIELDS, 0)
+    for row in rows:
+        for k in QUEUE_STATS_FIELDS:
+            totals[k] += getattr(row, k)
+    served = totals["served"]
+    totals["avg_wait_minutes"] = totals["sum_wait"] / served / 60 if served else None
+    totals["avg_service_minutes"] = totals["sum_service"] / served / 60 if served else None
 
     return render_template(
         "stats.html",
-        stats=stats,
+        stats=[(row.period, row.issued) for row in rows],
+        totals=totals,
+        analytics=queue_analytics(umkm.id, start_day, end_day),
+        weekday_labels=WEEKDAY_LABELS,
         umkm=umkm,
-        target_day=target_day
+        single_day=single_day,
+        start_day=start_day,
+        end_day=end_day
     )
 
-# @app.route("/dashboard/settings")
-# def dashboard_settings():
-#     user = get_current_user()
-#     if not user:
-#         return redirect(url_for("login"))
-
-#     umkm = user.umkm
-#     return render_template("settings.html", umkm=umkm)
-
 @app.route("/dashboard/settings", methods=["GET", "POST"])
 def dashboard_settings():
-    user = get_current_user()
-    if not user:
+    if not current_identity():
         return redirect(url_for("login"))
 
-    umkm = user.umkm
+    umkm = get_current_umkm()
     if not umkm:
         flash("UMKM tidak ditemukan.", "danger")
         return redirect(url_for("dashboard"))
@@ -1160,40 +3215,58 @@ def dashboard_settings():
         umkm.name = request.form.get("name", umkm.name)
         umkm.owner_whatsapp = request.form.get("owner_whatsapp", "").strip() or None 
         db.session.commit()
+        invalidate_umkm_cache(umkm.id)
         flash("Pengaturan berhasil disimpan.", "success")
         return redirect(url_for("dashboard_settings"))
 
-    return render_template("settings.html", umkm=umkm)
-
-
+    return render_template("settings.html", umkm=umkm, playlist=display_playlist(umkm.id))
 
-@app.route("/dashboard/settings/generate-qr", methods=["POST"])
-def generate_qr_route():
-    user = get_current_user()
-    if not user:
-        return redirect(url_for("login"))
 
-    umkm = user.umkm
-    try:
-        generate_umkm_qr(umkm)
-        flash("QR Code berhasil diperbarui!", "success")
-    except Exception as e:
-        flash(f"Gagal membuat QR: {e}", "danger")
 
-    return redirect(url_for("dashboard_settings"))
+@app.route("/qr/<slug>.<any(png, svg):fmt>")
+def qr_image(slug, fmt):
+    """
+    QR halaman publik UMKM berisi PUBLIC_BASE_URL/<slug> (sama dengan `flask regenerate-qr`).
+    ?size= = ukuran kotak per modul (2-40, default 10). Hasil render di-cache di qr_cache.
+    PUBLIC_BASE_URL kosong (development): pakai request.url_root, tapi tidak di-cache sama sekali
+    karena header Host bisa diisi sembarang oleh client.
+    """
+    box_size = min(max(request.args.get("size", 10, type=int), 2), 40)
+    base_url = app.config["PUBLIC_BASE_URL"]
+    key = (slug, box_size, fmt)
+
+    cached = qr_cache.get(key) if base_url else None
+    if cached is None:
+        if not UMKM.query.filter_by(slug=slug).first():
+            abort(404)
+        data = run_blocking(render_qr, umkm_public_url(base_url or request.url_root, slug), fmt, box_size)
+        cached = (hashlib.sha256(data).hexdigest()[:16], data)
+        if base_url:
+            qr_cache.set(key, cached)
+
+    etag, data = cached
+    response = app.response_class(data, mimetype=QR_MIMETYPES[fmt])
+    response.set_etag(etag)
+    if base_url:
+        response.cache_control.public = True
+        response.cache_control.max_age = 86400
+    else:
+        response.cache_control.no_store = True
+    return response.make_conditional(request)
 
 @app.route("/dashboard/settings/display", methods=["POST"])
 def dashboard_settings_display():
     """
     Simpan:
     - teks berjalan (display_ticker)
-    - upload image/video untuk display (disimpan sebagai path relatif dipisah koma)
+    - upload image untuk display (masuk tabel display_media)
+    Gambar diproses ke WebP di background dan baru masuk daftar display setelah selesai.
+    Video di-upload bertahap lewat video_upload_* (bukan lewat form ini).
     """
-    user = get_current_user()
-    if not user:
+    if not current_identity():
         return redirect(url_for("login"))
 
-    umkm = user.umkm
+    umkm = get_current_umkm()
     if not umkm:
         flash("UMKM tidak ditemukan.", "danger")
         return redirect(url_for("dashboard_settings"))
@@ -1206,106 +3279,237 @@ def dashboard_settings_display():
     umkm_folder = os.path.join(app.config["UPLOAD_FOLDER"], umkm.slug)
     os.makedirs(umkm_folder, exist_ok=True)
 
-    # existing list
-    current_images = [p for p in (umkm.display_images or "").split(",") if p.strip()]
-    current_videos = [p for p in (umkm.display_videos or "").split(",") if p.strip()]
-
-    # upload images
+    # upload images (masuk playlist lewat attach_display_image setelah diproses)
+    pending_images = []
     image_files = request.files.getlist("image_files")
     for f in image_files:
         if not f or not f.filename:
             continue
         if not allowed_file(f.filename, ALLOWED_IMAGE_EXT):
             continue
-        filename = secure_filename(f.filename)
-        # untuk menghindari nama bentrok
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
-        final_name = f"{timestamp}_{filename}"
-        rel_path = f"upload/{umkm.slug}/{final_name}"
-        abs_path = os.path.join("static", rel_path.replace("upload/", "upload/"))
-        # benerin path abs:
-        abs_path = os.path.join("static", "upload", umkm.slug, final_name)
-
-        f.save(abs_path)
-        current_images.append(rel_path)
-
-    # upload videos
-    video_files = request.files.getlist("video_files")
-    for f in video_files:
-        if not f or not f.filename:
-            continue
-        if not allowed_file(f.filename, ALLOWED_VIDEO_EXT):
-            continue
-        filename = secure_filename(f.filename)
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
-        final_name = f"{timestamp}_{filename}"
-        rel_path = f"upload/{umkm.slug}/{final_name}"
-        abs_path = os.path.join("static", "upload", umkm.slug, final_name)
+        # nama diberi timestamp untuk menghindari bentrok
+        pending_images.append((save_upload_tmp(f, umkm_folder), upload_rel_base(umkm, f.filename)))
+
+    db.session.commit()
+
+    for tmp_path, rel_base in pending_images:
+        process_image_in_background(
+            tmp_path, rel_base, app.config["IMAGE_VARIANT_WIDTHS"],
+            lambda rel_path, umkm_id=umkm.id: attach_display_image(umkm_id, rel_path)
+        )
+
+    if pending_images:
+        flash("Pengaturan display disimpan. Gambar sedang diproses dan akan tampil sebentar lagi.", "success")
+    else:
+        flash("Pengaturan display / kiosk berhasil disimpan.", "success")
+    return redirect(url_for("dashboard_settings"))
+
+
+@app.route("/dashboard/settings/display/videos/uploads", methods=["POST"])
+def video_upload_init():
+    """Mulai upload video bertahap. Body JSON: {filename, size}."""
+    umkm = get_current_umkm_cached()
+    if not umkm:
+        return jsonify({"error": "Silakan login ulang."}), 401
+
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(str(data.get("filename") or ""))
+    try:
+        size = int(data.get("size") or 0)
+    except (TypeError, ValueError):
+        size = 0
+
+    if not allowed_file(filename, ALLOWED_VIDEO_EXT):
+        return jsonify({"error": "Format video tidak didukung (mp4/webm/ogg)."}), 400
+    if size <= 0:
+        return jsonify({"error": "Ukuran file tidak valid."}), 400
+    if size > app.config["VIDEO_UPLOAD_MAX_BYTES"]:
+        return jsonify({"error": "Ukuran video terlalu besar."}), 413
+
+    os.makedirs(app.config["CHUNK_UPLOAD_FOLDER"], exist_ok=True)
+    purge_stale_chunk_uploads()
+
+    upload_id = secrets.token_hex(16)
+    meta = {
+        "umkm_id": umkm.id,
+        "filename": filename,
+        "size": size,
+        "chunk_size": app.config["CHUNK_UPLOAD_CHUNK_BYTES"],
+    }
+    part_path, meta_path = chunk_upload_paths(upload_id)
+    open(part_path, "wb").close()
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+
+    return jsonify({"upload_id": upload_id, "offset": 0, "size": size, "chunk_size": meta["chunk_size"]}), 201
+
+
+@app.route("/dashboard/settings/display/videos/uploads/<upload_id>", methods=["GET"])
+def video_upload_status(upload_id):
+    """Posisi terakhir yang sudah tersimpan di server (untuk melanjutkan upload)."""
+    umkm = get_current_umkm_cached()
+    if not umkm:
+        return jsonify({"error": "Silakan login ulang."}), 401
 
-        f.save(abs_path)
-        current_videos.append(rel_path)
+    meta = load_chunk_upload(upload_id, umkm)
+    if not meta:
+        return jsonify({"error": "Upload tidak ditemukan."}), 404
 
-    umkm.display_images = ",".join(current_images) if current_images else None
-    umkm.display_videos = ",".join(current_videos) if current_videos else None
+    part_path, _ = chunk_upload_paths(upload_id)
+    return jsonify({
+        "upload_id": upload_id,
+        "offset": chunk_upload_offset(part_path, meta),
+        "size": meta["size"],
+        "chunk_size": meta["chunk_size"],
+    })
 
+
+@app.route("/dashboard/settings/display/videos/uploads/<upload_id>", methods=["PUT"])
+def video_upload_chunk(upload_id):
+    """
+    Terima satu potongan (body mentah, ?offset=N). Ditulis streaming ke disk per 64KB.
+    Potongan yang terputus / checksum-nya salah dibuang, offset kembali ke awal potongan.
+    """
+    umkm = get_current_umkm_cached()
+    if not umkm:
+        return jsonify({"error": "Silakan login ulang."}), 401
+
+    meta = load_chunk_upload(upload_id, umkm)
+    if not meta:
+        return jsonify({"error": "Upload tidak ditemukan."}), 404
+
+    part_path, _ = chunk_upload_paths(upload_id)
+    current = chunk_upload_offset(part_path, meta)
+    offset = request.args.get("offset", type=int)
+    if offset != current:
+        return jsonify({"error": "Offset tidak sesuai.", "offset": current}), 409
+
+    expected = min(meta["chunk_size"], meta["size"] - offset)
+    if expected <= 0 or request.content_length != expected:
+        return jsonify({"error": "Ukuran potongan tidak sesuai.", "offset": current}), 400
+
+    digest = hashlib.sha256()
+    written = 0
+    with open(part_path, "r+b") as out:
+        out.seek(offset)
+        while written < expected:
+            block = request.stream.read(min(CHUNK_UPLOAD_READ_BYTES, expected - written))
+            if not block:
+                break
+            digest.update(block)
+            out.write(block)
+            written += len(block)
+
+        claimed = request.headers.get("X-Chunk-Sha256", "").lower()
+        if written != expected or (claimed and claimed != digest.hexdigest()):
+            out.truncate(offset)
+            return jsonify({"error": "Potongan rusak, kirim ulang.", "offset": offset}), 422
+
+    return jsonify({"offset": offset + written})
+
+
+@app.route("/dashboard/settings/display/videos/uploads/<upload_id>/complete", methods=["POST"])
+def video_upload_complete(upload_id):
+    """
+    Selesaikan upload: cek ukuran & checksum (body JSON wajib {checksum}), pindahkan ke
+    static/upload/<slug>/ lalu tambahkan ke akhir playlist display. Response memuat checksum
+    versi server supaya client bisa membandingkan sendiri.
+    """
+    umkm = get_current_umkm_cached()
+    if not umkm:
+        return jsonify({"error": "Silakan login ulang."}), 401
+
+    meta = load_chunk_upload(upload_id, umkm)
+    if not meta:
+        return jsonify({"error": "Upload tidak ditemukan."}), 404
+
+    part_path, meta_path = chunk_upload_paths(upload_id)
+    offset = chunk_upload_offset(part_path, meta)
+    if offset != meta["size"]:
+        return jsonify({"error": "Upload belum lengkap.", "offset": offset}), 409
+
+    claimed = str((request.get_json(silent=True) or {}).get("checksum") or "").lower()
+    if not claimed:
+        return jsonify({"error": "Checksum wajib dikirim."}), 400
+
+    checksum, sha256 = run_blocking(chunk_upload_checksums, part_path, meta["chunk_size"])
+    if claimed != checksum:
+        for path in (part_path, meta_path):
+            os.remove(path)
+        return jsonify({"error": "Checksum tidak cocok, silakan upload ulang."}), 422
+
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    rel_path = f"upload/{umkm.slug}/{timestamp}_{meta['filename']}"
+    os.makedirs(os.path.join("static", "upload", umkm.slug), exist_ok=True)
+    shutil.move(part_path, os.path.join("static", rel_path))
+    os.remove(meta_path)
+    remember_media_digest(rel_path, sha256)
+
+    add_display_media(umkm.id, "video", rel_path, size=meta["size"], sha256=sha256)
     db.session.commit()
 
-    flash("Pengaturan display / kiosk berhasil disimpan.", "success")
-    return redirect(url_for("dashboard_settings"))
+    return jsonify({"path": rel_path, "sha256": sha256, "checksum": checksum})
+
 
 @app.route("/dashboard/settings/display/delete", methods=["POST"])
 def dashboard_settings_display_delete():
     """
     Hapus 1 media (image/video) dari pengaturan display:
-    - hapus file fisik dari static/upload/...
-    - hapus path dari kolom display_images / display_videos
+    - hapus baris display_media
+    - hapus file fisik dari static/upload/... (termasuk varian WebP gambar)
     """
-    user = get_current_user()
-    if not user:
+    if not current_identity():
         return redirect(url_for("login"))
 
-    umkm = user.umkm
+    umkm = get_current_umkm()
     if not umkm:
         flash("UMKM tidak ditemukan.", "danger")
         return redirect(url_for("dashboard_settings"))
 
-    media_type = request.form.get("type")
-    path = request.form.get("path", "").strip()  # contoh: upload/slug/filename.png
-
-    if not path:
-        flash("Path media tidak valid.", "danger")
+    media = DisplayMedia.query.filter_by(
+        id=request.form.get("media_id", type=int), umkm_id=umkm.id
+    ).first()
+    if not media:
+        flash("Media tidak ditemukan dalam pengaturan.", "danger")
         return redirect(url_for("dashboard_settings"))
 
-    if media_type == "image":
-        field_name = "display_images"
-    elif media_type == "video":
-        field_name = "display_videos"
-    else:
-        flash("Tipe media tidak valid.", "danger")
-        return redirect(url_for("dashboard_settings"))
+    files = display_media_files(media)
+    db.session.delete(media)
+    db.session.commit()
 
-    current_list = [p.strip() for p in (getattr(umkm, field_name) or "").split(",") if p.strip()]
+    # hapus file fisik
+    for abs_path in files:
+        try:
+            if os.path.exists(abs_path):
+                os.remove(abs_path)
+        except Exception:
+            # kalau gagal hapus file, kita abaikan, yang penting DB konsisten
+            pass
 
-    if path not in current_list:
-        flash("Media tidak ditemukan dalam pengaturan.", "danger")
-        return redirect(url_for("dashboard_settings"))
+    flash("Media display berhasil dihapus.", "success")
+    return redirect(url_for("dashboard_settings"))
 
-    # hapus path dari list
-    current_list.remove(path)
-    setattr(umkm, field_name, ",".join(current_list) if current_list else None)
 
-    # hapus file fisik
-    abs_path = os.path.join("static", path)
-    try:
-        if os.path.exists(abs_path):
-            os.remove(abs_path)
-    except Exception:
-        # kalau gagal hapus file, kita abaikan, yang penting DB konsisten
-        pass
+@app.route("/dashboard/settings/display/move", methods=["POST"])
+def dashboard_settings_display_move():
+    """Naik/turunkan 1 media di urutan tayang display (direction = up / down)."""
+    if not current_identity():
+        return redirect(url_for("login"))
 
-    db.session.commit()
+    umkm = get_current_umkm()
+    if not umkm:
+        flash("UMKM tidak ditemukan.", "danger")
+        return redirect(url_for("dashboard_settings"))
 
-    flash("Media display berhasil dihapus.", "success")
+    media = DisplayMedia.query.filter_by(
+        id=request.form.get("media_id", type=int), umkm_id=umkm.id
+    ).first()
+    if not media:
+        flash("Media tidak ditemukan dalam pengaturan.", "danger")
+        return redirect(url_for("dashboard_settings"))
+
+    if move_display_media(media, -1 if request.form.get("direction") == "up" else 1):
+        db.session.commit()
     return redirect(url_for("dashboard_settings"))
 
 
@@ -1313,46 +3517,293 @@ def dashboard_settings_display_delete():
 def display_view(slug_umkm):
     """
     Mode display (kiosk) untuk UMKM tertentu.
-    Gunakan pengaturan display_ticker, display_images, display_videos.
+    Gunakan pengaturan display_ticker & playlist display_media.
     """
     umkm = UMKM.query.filter_by(slug=slug_umkm).first_or_404()
-    today = date.today()
+    snapshot = get_queue_snapshot(umkm)
+
+    playlist = [
+        {
+            "type": m.kind,
+            "src": media_url(m.path, m.hash),
+            "srcset": image_srcset(m.path) if m.kind == "image" else "",
+            "duration": m.duration,
+        }
+        for m in display_playlist(umkm.id)
+    ]
+    ticker = umkm.display_ticker or "Selamat datang di " + (umkm.name or "UMKM Anda")
 
-    current_called = (
-        Queue.query
-        .filter(
-            Queue.umkm_id == umkm.id,
-            Queue.status == "called",
-            db.func.date(Queue.created_at) == today
-        )
-        .order_by(Queue.called_at.desc())
-        .first()
+    return render_template(
+        "display.html",
+        umkm=umkm,
+        current_called=snapshot["current_called"],
+        waiting=snapshot["waiting"],
+        playlist=playlist,
+        ticker=ticker
     )
 
-    waiting_list = (
-        Queue.query
-        .filter(
-            Queue.umkm_id == umkm.id,
-            Queue.status == "waiting",
-            db.func.date(Queue.created_at) == today
+
+# --------------------------------------------------
+# SKEMA: UPGRADE DATABASE
+# --------------------------------------------------
+
+def column_exists(table: str, column: str) -> bool:
+    return any(c["name"] == column for c in db.inspect(db.engine).get_columns(table))
+
+
+def add_column_if_missing(table: str, column: str, ddl_type: str) -> bool:
+    """ALTER TABLE ... ADD COLUMN kalau kolom belum ada. Return True jika kolom baru dibuat."""
+    if column_exists(table, column):
+        return False
+    db.session.execute(db.text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+    db.session.commit()
+    return True
+
+
+def drop_foreign_key_if_exists(table: str, column: str):
+    """ALTER TABLE ... DROP CONSTRAINT untuk foreign key di kolom itu (hanya Postgres;
+    SQLite tidak menegakkan foreign key kecuali PRAGMA foreign_keys diaktifkan)."""
+    if db.engine.dialect.name != "postgresql":
+        return
+    for fk in db.inspect(db.engine).get_foreign_keys(table):
+        if fk["constrained_columns"] == [column] and fk.get("name"):
+            db.session.execute(db.text(f'ALTER TABLE {table} DROP CONSTRAINT "{fk["name"]}"'))
+    db.session.commit()
+
+
+def backfill_in_batches(table: str, set_sql: str, where_sql: str, batch_size: int = 5000):
+    """UPDATE bertahap (per batch id) supaya tidak mengunci tabel besar terlalu lama."""
+    while True:
+        result = db.session.execute(db.text(
+            f"UPDATE {table} SET {set_sql} "
+            f"WHERE id IN (SELECT id FROM {table} WHERE {where_sql} LIMIT {int(batch_size)})"
+        ))
+        db.session.commit()
+        if result.rowcount < batch_size:
+            break
+
+
+def ensure_sqlite_queue_ids():
+    """
+    SQLite: pastikan queues memakai AUTOINCREMENT (tabel lama dibangun ulang sekali) dan
+    sequence-nya sudah melewati id terbesar di queues_archive, supaya id tiket tidak dipakai ulang.
+    """
+    if db.engine.dialect.name != "sqlite":
+        return
+    table_sql = db.session.execute(db.text(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'queues'"
+    )).scalar() or ""
+    if "AUTOINCREMENT" not in table_sql.upper():
+        columns = ", ".join(c.name for c in Queue.__table__.columns)
+        # legacy_alter_table: referensi di tabel lain tidak ikut diganti ke queues_old
+        db.session.execute(db.text("PRAGMA legacy_alter_table = ON"))
+        db.session.execute(db.text("ALTER TABLE queues RENAME TO queues_old"))
+        for index in Queue.__table__.indexes:
+            db.session.execute(db.text(f"DROP INDEX IF EXISTS {index.name}"))
+        db.session.commit()
+        Queue.__table__.create(db.engine)
+        db.session.execute(db.text(f"INSERT INTO queues ({columns}) SELECT {columns} FROM queues_old"))
+        db.session.execute(db.text("DROP TABLE queues_old"))
+        db.session.execute(db.text("PRAGMA legacy_alter_table = OFF"))
+        db.session.commit()
+
+    max_id = db.session.execute(db.text(
+        "SELECT MAX(m) FROM (SELECT MAX(id) AS m FROM queues UNION ALL SELECT MAX(id) FROM queues_archive)"
+    )).scalar() or 0
+    seq = db.session.execute(db.text("SELECT seq FROM sqlite_sequence WHERE name = 'queues'")).scalar()
+    if seq is None:
+        db.session.execute(db.text("INSERT INTO sqlite_sequence (name, seq) VALUES ('queues', :seq)"), {"seq": max_id})
+    elif seq < max_id:
+        db.session.execute(db.text("UPDATE sqlite_sequence SET seq = :seq WHERE name = 'queues'"), {"seq": max_id})
+    db.session.commit()
+
+
+def migrate_display_media_columns():
+    rows = db.session.execute(db.text(
+        "SELECT id, display_videos, display_images FROM umkm"
+        " WHERE display_images IS NOT NULL OR display_videos IS NOT NULL"
+    )).all()
+    for umkm_id, videos, images in rows:
+        for kind, raw in (("video", videos), ("image", images)):
+            for path in (p.strip() for p in (raw or "").split(",")):
+                if not path:
+                    continue
+                abs_path = os.path.join("static", path)
+                exists = os.path.exists(abs_path)
+                add_display_media(
+                    umkm_id, kind, path,
+                    size=os.path.getsize(abs_path) if exists else None,
+                    sha256=file_sha256(abs_path) if exists else None
+                )
+                db.session.flush()
+        db.session.execute(
+            db.text("UPDATE umkm SET display_images = NULL, display_videos = NULL WHERE id = :id"),
+            {"id": umkm_id}
         )
-        .order_by(Queue.queue_number.asc())
+        db.session.commit()
+
+
+def upgrade_schema():
+    """
+    Buat tabel/kolom/index baru & isi data awalnya. Idempotent, aman dijalankan setiap deploy.
+    """
+    db.create_all()
+
+    # queues.service_date: isi dari tanggal created_at untuk tiket lama
+    add_column_if_missing("queues", "service_date", "DATE")
+    backfill_in_batches("queues", "service_date = DATE(created_at)", "service_date IS NULL")
+
+    # umkm.queue_version: versi snapshot antrian
+    add_column_if_missing("umkm", "queue_version", "INTEGER NOT NULL DEFAULT 0")
+
+    # umkm.credit_reserved: pesan berbayar yang masih antre di outbox saat upgrade dulu belum
+    # memesan kredit, jadi dipesan sekarang (sekali, saat kolom baru dibuat)
+    if add_column_if_missing("umkm", "credit_reserved", "INTEGER NOT NULL DEFAULT 0"):
+        in_flight = (
+            "(SELECT COUNT(*) FROM wa_outbox o WHERE o.umkm_id = umkm.id"
+            " AND o.charge_credit AND o.status IN ('pending', 'sending'))"
+        )
+        db.session.execute(db.text(
+            f"UPDATE umkm SET credit_reserved = {in_flight}, credit_balance = credit_balance - {in_flight}"
+        ))
+        db.session.commit()
+
+    # wa_logs.message_kind: isi dari tag di awal pesan lama (sekali saja, setelah itu tanpa LIKE)
+    add_column_if_missing("wa_logs", "message_kind", "VARCHAR(20)")
+    backfill_in_batches(
+        "wa_logs",
+        "message_kind = CASE"
+        " WHEN message LIKE '[AUTO_REMINDER]%' THEN 'AUTO_REMINDER'"
+        " WHEN message LIKE '[NEW_TICKET]%' THEN 'NEW_TICKET'"
+        " WHEN message LIKE '[TOPUP%' THEN 'TOPUP'"
+        " ELSE 'MANUAL' END",
+        "message_kind IS NULL"
+    )
+
+    # wa_logs.queue_id: tiket bisa pindah ke queues_archive, jadi foreign key ke queues dilepas
+    drop_foreign_key_if_exists("wa_logs", "queue_id")
+    ensure_sqlite_queue_ids()
+
+    # display_media: pindahkan daftar lama (dipisah koma) ke tabel; video dulu lalu gambar,
+    # sama seperti urutan playlist kiosk sebelumnya. Kolom lama dikosongkan supaya tidak diimpor lagi.
+    if column_exists("umkm", "display_images"):
+        migrate_display_media_columns()
+
+    # index baru di tabel lama (create_all tidak menambah index ke tabel yang sudah ada)
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+    # queue_stats_hourly: tabel baru / masih kosong → isi dari riwayat tiket
+    if not db.session.query(QueueStatsHourly.umkm_id).first():
+        rebuild_queue_stats()
+
+    # queue_counters: lanjutkan nomor antrian yang sudah terpakai hari ini
+    today = date.today()
+    last_numbers = (
+        db.session.query(Queue.umkm_id, db.func.max(Queue.queue_number))
+        .filter(Queue.service_date == today)
+        .group_by(Queue.umkm_id)
         .all()
     )
+    for umkm_id, last_number in last_numbers:
+        if not db.session.get(QueueCounter, (umkm_id, today)):
+            db.session.add(QueueCounter(
+                umkm_id=umkm_id,
+                service_date=today,
+                last_number=last_number or 0
+            ))
 
-    images = [p.strip() for p in (umkm.display_images or "").split(",") if p.strip()]
-    videos = [p.strip() for p in (umkm.display_videos or "").split(",") if p.strip()]
-    ticker = umkm.display_ticker or "Selamat datang di " + (umkm.name or "UMKM Anda")
+    db.session.commit()
 
-    return render_template(
-        "display.html",
-        umkm=umkm,
-        current_called=current_called,
-        waiting=waiting_list,
-        images=images,
-        videos=videos,
-        ticker=ticker
+
+@app.cli.command("upgrade-db")
+def upgrade_db_command():
+    """flask --app app upgrade-db"""
+    upgrade_schema()
+    print("Skema database sudah terbaru.")
+
+
+@app.cli.command("regenerate-qr")
+@click.option("--base-url", default=lambda: app.config["PUBLIC_BASE_URL"],
+              help="URL publik aplikasi, misal https://antrifast.id (default: env PUBLIC_BASE_URL).")
+@click.option("--workers", default=os.cpu_count() or 1, show_default=True, help="Jumlah proses render.")
+def regenerate_qr_command(base_url, workers):
+    """
+    Ekspor QR semua UMKM ke static/qr/<slug>.png & .svg (render paralel), untuk dicetak / dibagikan.
+    Aplikasi sendiri TIDAK memakai file ini: halaman pengaturan memakai /qr/<slug>.<fmt> yang
+    dirender dari PUBLIC_BASE_URL, jadi perintah ini tidak perlu dijalankan untuk memperbaruinya.
+    """
+    if not base_url:
+        raise click.UsageError("Isi --base-url atau env PUBLIC_BASE_URL.")
+
+    slugs = [slug for (slug,) in db.session.query(UMKM.slug).filter(UMKM.slug.isnot(None))]
+    jobs = [(slug, fmt) for slug in slugs for fmt in QR_MIMETYPES]
+
+    qr_folder = os.path.join("static", "qr")
+    os.makedirs(qr_folder, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(
+            render_qr,
+            [umkm_public_url(base_url, slug) for slug, _ in jobs],
+            [fmt for _, fmt in jobs],
+            chunksize=16
+        )
+        for (slug, fmt), data in zip(jobs, results):
+            with open(os.path.join(qr_folder, f"{slug}.{fmt}"), "wb") as f:
+                f.write(data)
+
+    print(f"QR {len(slugs)} UMKM diekspor ke {qr_folder}.")
+
+
+@app.cli.command("rebuild-stats")
+@click.option("--umkm-id", type=int, default=None, help="Hanya UMKM ini (default: semua).")
+def rebuild_stats_command(umkm_id):
+    """Hitung ulang tabel queue_stats_hourly dari tabel queues & queues_archive."""
+    count = rebuild_queue_stats(umkm_id)
+    print(f"{count} baris statistik per jam dibangun ulang.")
+
+
+@app.cli.command("archive-queues")
+@click.option("--keep-days", default=0, show_default=True,
+              help="Jumlah hari sebelum hari ini yang tetap di tabel queues (0 = hanya hari ini).")
+@click.option("--batch-size", default=5000, show_default=True, help="Jumlah tiket per transaksi.")
+def archive_queues_command(keep_days, batch_size):
+    """Pindahkan tiket hari-hari sebelumnya ke queues_archive (jadwalkan tiap malam lewat cron)."""
+    before = date.today() - timedelta(days=keep_days)
+    moved = archive_queues(before, batch_size)
+    print(f"{moved} tiket sebelum {before.isoformat()} dipindah ke queues_archive.")
+
+
+@app.cli.command("purge-wa-logs")
+@click.option("--body-days", type=int, default=lambda: app.config["WA_LOG_BODY_RETENTION_DAYS"],
+              help="Kosongkan isi pesan & respons log yang lebih tua dari N hari (default: env WA_LOG_BODY_RETENTION_DAYS).")
+@click.option("--days", type=int, default=lambda: app.config["WA_LOG_RETENTION_DAYS"],
+              help="Hapus log yang lebih tua dari N hari, 0 = simpan (default: env WA_LOG_RETENTION_DAYS).")
+@click.option("--batch-size", default=5000, show_default=True, help="Jumlah log per transaksi.")
+def purge_wa_logs_command(body_days, days, batch_size):
+    """Retensi wa_logs & wa_outbox (jadwalkan tiap malam lewat cron, bersama archive-queues)."""
+    now = datetime.now()
+    stripped, deleted, outbox_deleted = purge_wa_logs(
+        now - timedelta(days=body_days),
+        now - timedelta(days=days) if days > 0 else None,
+        batch_size
     )
+    print(
+        f"{stripped} log WA dikosongkan isinya, {deleted} log WA dihapus, "
+        f"{outbox_deleted} pesan outbox selesai dihapus."
+    )
+
+
+@app.cli.command("wa-worker")
+@click.option("--once", is_flag=True, help="Proses satu batch lalu keluar.")
+def wa_worker_command(once):
+    """Jalankan worker outbox WA di proses terpisah (set WA_OUTBOX_AUTOSTART=0 di web)."""
+    if once:
+        print(f"{wa_outbox.run_once()} pesan diproses.")
+        return
+    wa_outbox.run_forever()
 
 
 # --------------------------------------------------
@@ -1361,5 +3812,5 @@ def display_view(slug_umkm):
 
 if __name__ == "__main__":
     with app.app_context():
-        db.create_all()
+        upgrade_schema()
     socketio.run(app, debug=True)
@@ -0,0 +1,59 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_PATH = os.path.join(tempfile.mkdtemp(prefix="antrifast-test-"), "test.db")
+
+# konfigurasi dibaca saat app diimport: SQLite lokal, tanpa worker outbox & tanpa jeda broadcast
+os.environ["DATABASE_URL"] = f"sqlite:///{DB_PATH}"
+os.environ["WA_OUTBOX_AUTOSTART"] = "0"
+os.environ["BROADCAST_COALESCE_MS"] = "0"
+
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # path upload/static relatif ke root repo
+
+import app as antrifast  # noqa: E402
+
+
+@pytest.fixture
+def app(monkeypatch, tmp_path):
+    flask_app = antrifast.app
+    flask_app.config["TESTING"] = True
+    monkeypatch.setitem(flask_app.config, "CHUNK_UPLOAD_FOLDER", str(tmp_path / "chunk_uploads"))
+
+    # cache per proses dikosongkan supaya tidak bocor antar test (id di DB mulai dari 1 lagi)
+    for name in ("queue_snapshot_cache", "umkm_cache", "qr_cache", "media_digest_cache"):
+        monkeypatch.setattr(antrifast, name, antrifast.LRUCache(getattr(antrifast, name).maxsize))
+    monkeypatch.setattr(antrifast, "service_estimator", antrifast.ServiceTimeEstimator(
+        flask_app.config["ETA_EWMA_ALPHA"], flask_app.config["ETA_MAX_SAMPLE_MINUTES"] * 60.0
+    ))
+
+    with flask_app.app_context():
+        antrifast.db.drop_all()
+        antrifast.upgrade_schema()
+    yield flask_app
+    with flask_app.app_context():
+        antrifast.db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def owner(client):
+    """Daftar + login satu UMKM (slug "toko", saldo awal 10 kredit). Return id UMKM."""
+    client.post("/register", data={
+        "name": "Pemilik", "email": "owner@example.com", "password": "rahasia",
+        "umkm_name": "Toko", "slug": "toko", "owner_whatsapp": ""
+    })
+    client.post("/login", data={"email": "owner@example.com", "password": "rahasia"})
+    with client.session_transaction() as sess:
+        umkm_id = sess["umkm_id"]
+    yield umkm_id
+    shutil.rmtree(os.path.join("static", "upload", "toko"), ignore_errors=True)
@@ -0,0 +1,86 @@
+import threading
+import time
+from datetime import date, timedelta
+
+import app as antrifast
+
+
+def take(client, name="Budi"):
+    return client.post("/toko/take", data={"customer_name": name})
+
+
+def test_state_etag_and_304(client, owner):
+    take(client)
+
+    response = client.get("/api/toko/state")
+    assert response.status_code == 200
+    assert response.json["version"] == 1
+    assert [t["number"] for t in response.json["waiting"]] == [1]
+
+    etag = response.headers["ETag"]
+    response = client.get("/api/toko/state", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+
+
+def test_state_unknown_slug(client):
+    assert client.get("/api/tidak-ada/state").status_code == 404
+
+
+def test_long_poll_times_out_with_304(client, owner):
+    etag = client.get("/api/toko/state").headers["ETag"]
+
+    started = time.monotonic()
+    response = client.get("/api/toko/state?wait=0.3", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert time.monotonic() - started >= 0.3
+
+
+def test_long_poll_returns_when_version_changed(app, client, owner):
+    etag = client.get("/api/toko/state").headers["ETag"]
+
+    # tiket diambil dari thread lain SAAT request sedang menunggu → harus dibangunkan notifier,
+    # bukan menunggu API_STATE_POLL_SECONDS (5 detik)
+    def take_later():
+        time.sleep(0.3)
+        take(app.test_client())
+
+    taker = threading.Thread(target=take_later)
+    started = time.monotonic()
+    taker.start()
+    response = client.get("/api/toko/state?wait=10", headers={"If-None-Match": etag})
+    elapsed = time.monotonic() - started
+    taker.join()
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert [t["number"] for t in response.json["waiting"]] == [1]
+    assert 0.3 <= elapsed < 2
+
+
+def test_etag_changes_with_service_date(app, client, owner, monkeypatch):
+    take(client)
+    etag = client.get("/api/toko/state").headers["ETag"]
+
+    tomorrow = date.today() + timedelta(days=1)
+
+    class Tomorrow(date):
+        @classmethod
+        def today(cls):
+            return tomorrow
+
+    monkeypatch.setattr(antrifast, "date", Tomorrow)
+    response = client.get("/api/toko/state", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json["waiting"] == []
+
+
+def test_non_finite_wait_is_rejected(client, owner):
+    etag = client.get("/api/toko/state").headers["ETag"]
+
+    for value in ("nan", "NaN", "inf", "-inf"):
+        started = time.monotonic()
+        response = client.get(f"/api/toko/state?wait={value}", headers={"If-None-Match": etag})
+        assert response.status_code == 400
+        assert time.monotonic() - started < 1
@@ -0,0 +1,17 @@
+from datetime import date, timedelta
+
+from app import QueueArchive, Queue, archive_queues, db
+
+
+def test_archive_never_reuses_ticket_ids(app, client, owner):
+    tomorrow = date.today() + timedelta(days=1)
+    for _ in range(3):
+        client.post("/toko/take", data={"customer_name": "Budi"})
+        with app.app_context():
+            assert archive_queues(tomorrow) == 1
+            assert Queue.query.count() == 0
+
+    with app.app_context():
+        ids = [row.id for row in QueueArchive.query.order_by(QueueArchive.id)]
+        assert ids == sorted(set(ids)) and len(ids) == 3
+        db.session.remove()
@@ -0,0 +1,54 @@
+from types import SimpleNamespace
+
+import app as antrifast
+
+
+class FakeSocketIO:
+    def __init__(self):
+        self.emitted = []
+        self.tasks = []
+
+    def start_background_task(self, fn, *args):
+        self.tasks.append((fn, args))
+
+    def sleep(self, seconds):
+        pass
+
+    def emit(self, event, data, room=None):
+        self.emitted.append((event, data, room))
+
+    def run_tasks(self):
+        while self.tasks:
+            fn, args = self.tasks.pop(0)
+            fn(*args)
+
+
+def test_contiguous_deltas_are_coalesced(app, monkeypatch):
+    monkeypatch.setitem(app.config, "BROADCAST_COALESCE_MS", 50)
+    sio = FakeSocketIO()
+    broadcaster = antrifast.RoomBroadcaster(app, sio)
+    umkm = SimpleNamespace(id=1, slug="toko")
+
+    broadcaster.publish_delta(umkm, 2, [{"op": "added"}])
+    broadcaster.publish_delta(umkm, 3, [{"op": "called"}])
+    sio.run_tasks()
+
+    assert sio.emitted == [("queue_delta", {
+        "base_version": 1, "version": 3, "ops": [{"op": "added"}, {"op": "called"}],
+        "service_seconds": None
+    }, "toko")]
+    assert broadcaster.counters == {"requested": 2, "emitted": 1, "saved": 1}
+
+
+def test_gap_in_versions_sends_one_snapshot(app, client, owner, monkeypatch):
+    monkeypatch.setitem(app.config, "BROADCAST_COALESCE_MS", 50)
+    sio = FakeSocketIO()
+    broadcaster = antrifast.RoomBroadcaster(app, sio)
+    umkm = SimpleNamespace(id=owner, slug="toko")
+
+    broadcaster.publish_delta(umkm, 2, [{"op": "added"}])
+    broadcaster.publish_delta(umkm, 5, [{"op": "called"}])  # versi 3-4 dari worker lain
+    sio.run_tasks()
+
+    assert [(event, room) for event, _, room in sio.emitted] == [("queue_update", "toko")]
+    assert "waiting" in sio.emitted[0][1]
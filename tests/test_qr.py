@@ -0,0 +1,31 @@
+import io
+
+from PIL import Image
+
+import app as antrifast
+
+
+def test_qr_ignores_host_header(app, client, owner, monkeypatch):
+    monkeypatch.setitem(app.config, "PUBLIC_BASE_URL", "https://antrifast.example")
+    rendered = []
+    real_render = antrifast.render_qr
+    monkeypatch.setattr(antrifast, "render_qr", lambda url, *args: rendered.append(url) or real_render(url, *args))
+
+    first = client.get("/qr/toko.svg")
+    spoofed = client.get("/qr/toko.svg", headers={"Host": "evil.example"})
+
+    assert first.status_code == spoofed.status_code == 200
+    assert spoofed.data == first.data
+    assert rendered == ["https://antrifast.example/toko"]
+    assert "public" in first.headers["Cache-Control"]
+    assert list(antrifast.qr_cache._data) == [("toko", 10, "svg")]
+
+
+def test_qr_without_public_base_url_is_not_cached(app, client, owner, monkeypatch):
+    monkeypatch.setitem(app.config, "PUBLIC_BASE_URL", "")
+
+    response = client.get("/qr/toko.png")
+    assert response.status_code == 200
+    assert Image.open(io.BytesIO(response.data)).format == "PNG"
+    assert "no-store" in response.headers["Cache-Control"]
+    assert len(antrifast.qr_cache) == 0
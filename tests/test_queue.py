@@ -0,0 +1,88 @@
+from datetime import date, timedelta
+
+import app as antrifast
+
+
+def take(client, name="Budi"):
+    return client.post("/toko/take", data={"customer_name": name})
+
+
+def ticket(app, number):
+    with app.app_context():
+        return antrifast.Queue.query.filter_by(queue_number=number).one()
+
+
+def snapshot(app, umkm_id):
+    with app.app_context():
+        umkm = antrifast.db.session.get(antrifast.UMKM, umkm_id)
+        return antrifast.get_queue_snapshot(umkm)
+
+
+def test_finish_twice_is_rejected_and_history_not_duplicated(app, client, owner):
+    take(client)
+    q = ticket(app, 1)
+    snapshot(app, owner)  # isi cache supaya jalur write-through ikut teruji
+
+    client.post(f"/dashboard/queue/finish/{q.id}")
+    version = snapshot(app, owner)["version"]
+    client.post(f"/dashboard/queue/finish/{q.id}")
+    client.post(f"/dashboard/queue/cancel/{q.id}")
+
+    snap = snapshot(app, owner)
+    assert snap["version"] == version
+    assert [e.id for e in snap["history"]] == [q.id]
+    assert ticket(app, 1).status == "done"
+
+
+def test_ticket_from_another_day_cannot_be_changed(app, client, owner):
+    take(client)
+    with app.app_context():
+        q = antrifast.Queue.query.filter_by(queue_number=1).one()
+        q.service_date = date.today() - timedelta(days=1)
+        antrifast.db.session.commit()
+        queue_id = q.id
+
+    client.post(f"/dashboard/queue/cancel/{queue_id}")
+    assert ticket(app, 1).status == "waiting"
+
+
+def test_apply_queue_ops_ignores_other_days(app, client, owner):
+    snap = snapshot(app, owner)
+    stale = antrifast.QueueEntry(99, 1, "Budi", None, "done", None, date.today() - timedelta(days=1))
+
+    new = antrifast.apply_queue_ops(snap, snap["version"] + 1, [("removed", stale)])
+    assert new["history"] == ()
+
+
+def test_skip_does_not_feed_service_estimate(app, client, owner):
+    take(client, "A")
+    take(client, "B")
+    client.post("/dashboard/queue/next")  # panggil #1
+    client.post("/dashboard/queue/skip")  # #1 no_show, panggil #2
+    assert antrifast.service_estimator.get(owner) is None
+
+    client.post("/dashboard/queue/next")  # #2 done
+    assert antrifast.service_estimator.get(owner) is not None
+
+
+def test_stale_session_is_redirected(app, client, owner):
+    client.get("/dashboard/stats")  # isi umkm_cache dengan pemilik lama
+    with app.app_context():
+        umkm = antrifast.db.session.get(antrifast.UMKM, owner)
+        umkm.user_id = None  # UMKM dipindah / dilepas dari akun ini
+        antrifast.db.session.commit()
+    antrifast.invalidate_umkm_cache(owner)
+
+    for url in ("/dashboard/queue/next", "/dashboard/queue/skip", "/dashboard/queue/finish/1",
+                "/dashboard/queue/cancel/1", "/dashboard/wa/send/1"):
+        response = client.post(url)
+        assert response.status_code == 302
+        assert response.headers["Location"] == "/"
+    assert client.get("/dashboard/stats").status_code == 302
+    assert client.get("/dashboard").status_code == 302
+    assert client.get("/dashboard/settings").status_code == 302
+
+    response = client.post("/dashboard/settings", data={"name": "hijacked", "owner_whatsapp": ""})
+    assert response.status_code == 302
+    with app.app_context():
+        assert antrifast.db.session.get(antrifast.UMKM, owner).name == "Toko"
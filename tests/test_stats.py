@@ -0,0 +1,61 @@
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+
+import app as antrifast
+
+
+def rollup(app, umkm_id):
+    with app.app_context():
+        rows = antrifast.QueueStatsHourly.query.filter_by(umkm_id=umkm_id).all()
+        return sorted(
+            (row.hour, tuple(getattr(row, k) for k in antrifast.QUEUE_STATS_FIELDS)) for row in rows
+        )
+
+
+def test_done_ticket_without_finished_at_is_deterministic():
+    created = datetime(2026, 1, 5, 9, 0)
+    q = SimpleNamespace(status="done", created_at=created, called_at=created + timedelta(minutes=5),
+                        finished_at=None)
+
+    stats = antrifast.ticket_stats(q)
+    assert stats["served"] == 1
+    assert stats["sum_wait"] == 300
+    assert stats["sum_service"] == 0
+    assert antrifast.ticket_stats(q) == stats
+
+
+def test_rebuild_matches_live_rollup(app, client, owner):
+    for name in ("A", "B", "C"):
+        client.post("/toko/take", data={"customer_name": name})
+    client.post("/dashboard/queue/next")
+    client.post("/dashboard/queue/skip")
+    client.post("/dashboard/queue/next")
+
+    live = rollup(app, owner)
+    with app.app_context():
+        assert antrifast.rebuild_queue_stats(owner) == len(live)
+    assert rollup(app, owner) == live
+
+
+def test_range_is_summed_per_day_in_sql(app, client, owner):
+    start = datetime(2025, 1, 1)
+    with app.app_context():
+        antrifast.db.session.execute(antrifast.db.insert(antrifast.QueueStatsHourly), [
+            {"umkm_id": owner, "hour": start + timedelta(hours=h), "issued": 2, "served": 1,
+             "no_show": 0, "canceled": 0, "sum_wait": 60.0, "sum_service": 120.0}
+            for h in range(0, 24 * 365, 1)
+            if 8 <= h % 24 < 20
+        ])
+        antrifast.db.session.commit()
+
+        rows = antrifast.queue_stats_range(owner, start.date(), date(2025, 12, 31), by_day=True)
+        assert len(rows) == 365
+        assert rows[0].period == date(2025, 1, 1)
+        assert (rows[0].issued, rows[0].served, rows[0].sum_service) == (24, 12, 1440.0)
+
+        hourly = antrifast.queue_stats_range(owner, date(2025, 1, 2), date(2025, 1, 2))
+        assert [row.period.hour for row in hourly] == list(range(8, 20))
+
+    response = client.get("/dashboard/stats?start=2025-01-01&end=2025-12-31")
+    assert response.status_code == 200
+    assert b"Wed, 01 Jan - 24 antrian" in response.data
@@ -0,0 +1,51 @@
+import io
+import os
+
+from PIL import Image
+
+import app as antrifast
+
+
+def start_topup(client):
+    response = client.post("/dashboard/topup/start", data={
+        "package_name": "Paket Kecil", "credits": "50", "amount": "10000"
+    })
+    return int(response.headers["Location"].rstrip("/").split("/")[-2])
+
+
+def png_bytes():
+    buf = io.BytesIO()
+    Image.new("RGB", (32, 32), (200, 30, 30)).save(buf, "PNG")
+    return buf.getvalue()
+
+
+def test_confirm_processes_proof_before_notifying_admin(app, client, owner):
+    tx_id = start_topup(client)
+
+    response = client.post(f"/dashboard/topup/{tx_id}/confirm", data={
+        "sender_name": "Budi", "proof_image": (io.BytesIO(png_bytes()), "bukti.png")
+    }, content_type="multipart/form-data")
+    assert response.status_code == 302
+
+    with app.app_context():
+        tx = antrifast.db.session.get(antrifast.TopupTransaction, tx_id)
+        assert tx.status == "waiting_admin"
+        assert tx.proof_image and tx.proof_image.endswith(".webp")
+        assert os.path.exists(os.path.join("static", tx.proof_image))
+        assert antrifast.WAOutbox.query.filter_by(kind="TOPUP").count() == 1
+
+
+def test_unreadable_proof_keeps_tx_pending(app, client, owner):
+    tx_id = start_topup(client)
+
+    response = client.post(f"/dashboard/topup/{tx_id}/confirm", data={
+        "sender_name": "Budi", "proof_image": (io.BytesIO(b"bukan gambar"), "bukti.png")
+    }, content_type="multipart/form-data")
+    assert response.status_code == 302
+    assert response.headers["Location"].endswith(f"/dashboard/topup/{tx_id}/confirm")
+
+    with app.app_context():
+        tx = antrifast.db.session.get(antrifast.TopupTransaction, tx_id)
+        assert tx.status == "pending"
+        assert tx.proof_image is None
+        assert antrifast.WAOutbox.query.filter_by(kind="TOPUP").count() == 0
@@ -0,0 +1,44 @@
+import hashlib
+import os
+
+UPLOADS = "/dashboard/settings/display/videos/uploads"
+
+
+def upload_chunks(client, monkeypatch, data, chunk_size=4):
+    monkeypatch.setitem(client.application.config, "CHUNK_UPLOAD_CHUNK_BYTES", chunk_size)
+    response = client.post(UPLOADS, json={"filename": "promo.mp4", "size": len(data)})
+    assert response.status_code in (200, 201)
+    url = f"{UPLOADS}/{response.json['upload_id']}"
+
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    offset = 0
+    for chunk in chunks:
+        response = client.put(f"{url}?offset={offset}", data=chunk,
+                              headers={"X-Chunk-Sha256": hashlib.sha256(chunk).hexdigest()})
+        assert response.status_code == 200
+        offset += len(chunk)
+
+    checksum = hashlib.sha256(
+        "".join(hashlib.sha256(chunk).hexdigest() for chunk in chunks).encode()
+    ).hexdigest()
+    return url, checksum
+
+
+def test_complete_requires_checksum(client, owner, monkeypatch):
+    url, checksum = upload_chunks(client, monkeypatch, b"video-bytes-123")
+
+    assert client.post(f"{url}/complete", json={}).status_code == 400
+
+    response = client.post(f"{url}/complete", json={"checksum": checksum})
+    assert response.status_code == 200
+    assert response.json["checksum"] == checksum
+    with open(os.path.join("static", response.json["path"]), "rb") as f:
+        assert f.read() == b"video-bytes-123"
+
+
+def test_complete_rejects_wrong_checksum(client, owner, monkeypatch):
+    url, _ = upload_chunks(client, monkeypatch, b"video-bytes-123")
+
+    response = client.post(f"{url}/complete", json={"checksum": "0" * 64})
+    assert response.status_code == 422
+    assert client.get(url).status_code == 404
@@ -0,0 +1,50 @@
+import app as antrifast
+
+
+def tripped_client(app, monkeypatch):
+    monkeypatch.setitem(app.config, "WA_BREAKER_THRESHOLD", 2)
+    monkeypatch.setitem(app.config, "WA_BREAKER_COOLDOWN_SECONDS", 0)
+    client = antrifast.WAGatewayClient(app)
+    for _ in range(2):
+        allowed, trial = client._allow()
+        assert allowed and not trial
+        client._record(False, 1.0, trial)
+    return client
+
+
+def test_only_trial_result_closes_breaker(app, monkeypatch):
+    client = tripped_client(app, monkeypatch)
+
+    # kiriman lama (bukan percobaan) selesai saat half-open: slot percobaan tetap terpakai
+    allowed, trial = client._allow()
+    assert allowed and trial
+    client._record(True, 1.0, False)
+    assert client._allow() == (False, False)
+    assert client.stats()["state"] == "half_open"
+
+    client._record(True, 1.0, True)
+    assert client.stats()["state"] == "closed"
+    assert client._allow() == (True, False)
+
+
+def test_failed_trial_reopens_breaker(app, monkeypatch):
+    client = tripped_client(app, monkeypatch)
+    monkeypatch.setitem(app.config, "WA_BREAKER_COOLDOWN_SECONDS", 60)
+
+    allowed, trial = client._allow()
+    assert allowed and trial
+    client._record(False, 1.0, True)
+    assert client.stats()["state"] == "open"
+    assert client._allow() == (False, False)
+
+
+def test_metrics_requires_token(app, client, monkeypatch):
+    assert client.get("/admin/metrics").status_code == 404
+
+    monkeypatch.setitem(app.config, "ADMIN_METRICS_TOKEN", "s3cret")
+    assert client.get("/admin/metrics").status_code == 403
+    assert client.get("/admin/metrics", headers={"Authorization": "Bearer salah"}).status_code == 403
+
+    response = client.get("/admin/metrics", headers={"Authorization": "Bearer s3cret"})
+    assert response.status_code == 200
+    assert "wa_gateway" in response.json
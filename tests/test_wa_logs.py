@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+
+import app as antrifast
+
+NOW = datetime(2026, 6, 1, 12, 0)
+
+
+def add_log(days_ago, **fields):
+    log = antrifast.WALog(
+        phone_number="628111", message="Halo Budi", message_kind="MANUAL", status="200",
+        response_raw='{"status":true}', created_at=NOW - timedelta(days=days_ago), **fields
+    )
+    antrifast.db.session.add(log)
+    return log
+
+
+def add_outbox(days_ago, status):
+    row = antrifast.WAOutbox(
+        phone_number="628111", message="Halo Budi", kind="MANUAL", status=status,
+        created_at=NOW - timedelta(days=days_ago)
+    )
+    antrifast.db.session.add(row)
+    return row
+
+
+def test_purge_strips_and_deletes_logs_in_batches(app):
+    with app.app_context():
+        for days_ago in (400, 400, 400, 40, 40, 40, 1):
+            add_log(days_ago)
+        antrifast.db.session.commit()
+
+        result = antrifast.purge_wa_logs(NOW - timedelta(days=30), NOW - timedelta(days=365), batch_size=2)
+        assert result == (3, 3, 0)
+
+        logs = antrifast.WALog.query.order_by(antrifast.WALog.created_at).all()
+        assert [log.message for log in logs] == [None, None, None, "Halo Budi"]
+        assert all(log.response_raw is None for log in logs[:3])
+        assert all(log.status == "200" for log in logs)
+
+        # dijalankan ulang: tidak ada yang berubah
+        assert antrifast.purge_wa_logs(NOW - timedelta(days=30), NOW - timedelta(days=365)) == (0, 0, 0)
+
+
+def test_purge_without_delete_cutoff_keeps_old_logs(app):
+    with app.app_context():
+        add_log(400)
+        antrifast.db.session.commit()
+
+        assert antrifast.purge_wa_logs(NOW - timedelta(days=30)) == (1, 0, 0)
+        assert antrifast.WALog.query.count() == 1
+
+
+def test_purge_deletes_only_finished_old_outbox_rows(app):
+    with app.app_context():
+        for status in ("sent", "failed", "sent", "pending", "sending"):
+            add_outbox(40, status)
+        add_outbox(1, "sent")
+        antrifast.db.session.commit()
+
+        assert antrifast.purge_wa_logs(NOW - timedelta(days=30), batch_size=2) == (0, 0, 3)
+
+        remaining = sorted(
+            (row.status, (NOW - row.created_at).days) for row in antrifast.WAOutbox.query.all()
+        )
+        assert remaining == [("pending", 40), ("sending", 40), ("sent", 1)]
@@ -0,0 +1,197 @@
+import json
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import app as antrifast
+
+
+class StubGateway:
+    """Gateway WA palsu di localhost: catat tiap kiriman, jawab dengan status dari `responses` (default 200)."""
+
+    def __init__(self):
+        self.calls = []
+        self.responses = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                stub.calls.append(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+                code = stub.responses.pop(0) if stub.responses else 200
+                body = b'{"status":true}'
+                self.send_response(code)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/send-message"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+@pytest.fixture
+def gateway(app, monkeypatch):
+    stub = StubGateway()
+    monkeypatch.setitem(app.config, "WA_API_URL", stub.url)
+    monkeypatch.setattr(antrifast, "wa_gateway", antrifast.WAGatewayClient(app))
+    yield stub
+    stub.server.shutdown()
+    stub.server.server_close()
+
+
+@pytest.fixture
+def dispatcher(app):
+    worker = antrifast.WAOutboxDispatcher(app)
+    yield worker
+    if worker.pool:
+        worker.pool.shutdown()
+
+
+def take(client, name="Budi", phone="628111"):
+    return client.post("/toko/take", data={"customer_name": name, "customer_phone": phone})
+
+
+def outbox_rows(app, kind=None):
+    with app.app_context():
+        query = antrifast.WAOutbox.query.order_by(antrifast.WAOutbox.id)
+        if kind:
+            query = query.filter_by(kind=kind)
+        return query.all()
+
+
+def credits(app, umkm_id):
+    with app.app_context():
+        umkm = antrifast.db.session.get(antrifast.UMKM, umkm_id)
+        return umkm.credit_balance, umkm.credit_reserved
+
+
+def make_due(app):
+    with app.app_context():
+        antrifast.db.session.execute(
+            antrifast.db.update(antrifast.WAOutbox)
+            .values(next_attempt_at=datetime.now() - timedelta(seconds=1))
+        )
+        antrifast.db.session.commit()
+
+
+def test_drain_sends_and_commits_credit(app, client, owner, gateway, dispatcher):
+    take(client)
+    assert credits(app, owner) == (9, 1)
+
+    assert dispatcher.run_once() == 1
+    assert dispatcher.run_once() == 0
+
+    assert [call["number"] for call in gateway.calls] == ["628111"]
+    (row,) = outbox_rows(app)
+    assert row.status == "sent" and row.sent_at is not None
+    assert credits(app, owner) == (9, 0)
+    with app.app_context():
+        assert antrifast.WALog.query.filter_by(message_kind="NEW_TICKET", status="200").count() == 1
+        assert antrifast.CreditLog.query.filter_by(umkm_id=owner, change=-1).count() == 1
+
+
+def test_server_error_is_retried_with_backoff(app, client, owner, gateway, dispatcher):
+    gateway.responses = [500]
+    take(client)
+
+    started = datetime.now()
+    assert dispatcher.run_once() == 1
+    (row,) = outbox_rows(app)
+    assert row.status == "pending" and row.attempts == 1
+    assert row.next_attempt_at >= started + timedelta(seconds=app.config["WA_OUTBOX_RETRY_BASE_SECONDS"])
+    assert credits(app, owner) == (9, 1)  # kredit tetap dipesan selama masih dicoba
+
+    # belum jatuh tempo: tidak diklaim lagi
+    assert dispatcher.run_once() == 0
+
+    make_due(app)
+    assert dispatcher.run_once() == 1
+    (row,) = outbox_rows(app)
+    assert row.status == "sent" and row.attempts == 2
+    assert len(gateway.calls) == 2
+    assert credits(app, owner) == (9, 0)
+
+
+def test_retry_delay_is_exponential(app, monkeypatch):
+    monkeypatch.setitem(app.config, "WA_OUTBOX_RETRY_BASE_SECONDS", 15)
+    delays = [antrifast.outbox_retry_delay(n).total_seconds() for n in (1, 2, 3, 20)]
+    assert delays == [15, 30, 60, 3600]
+
+
+def test_permanent_failure_releases_credit(app, client, owner, gateway, dispatcher):
+    gateway.responses = [400]
+    take(client)
+
+    assert dispatcher.run_once() == 1
+    (row,) = outbox_rows(app)
+    assert row.status == "failed"
+    assert credits(app, owner) == (10, 0)
+    with app.app_context():
+        assert antrifast.CreditLog.query.filter_by(umkm_id=owner, change=-1).count() == 0
+
+
+def test_exhausted_retries_release_credit(app, client, owner, gateway, dispatcher, monkeypatch):
+    monkeypatch.setitem(app.config, "WA_OUTBOX_MAX_ATTEMPTS", 2)
+    gateway.responses = [503, 503]
+    take(client)
+
+    dispatcher.run_once()
+    make_due(app)
+    dispatcher.run_once()
+
+    (row,) = outbox_rows(app)
+    assert row.status == "failed" and row.attempts == 2
+    assert credits(app, owner) == (10, 0)
+
+
+def test_auto_reminder_sent_once_per_ticket(app, client, owner, gateway, dispatcher):
+    for i in range(5):
+        take(client, name=f"P{i + 1}", phone=f"62811{i + 1}")
+    dispatcher.run_once()
+
+    client.post("/dashboard/queue/next")  # panggil #1 → reminder ke #2..#4
+    assert [r.queue_id for r in outbox_rows(app, "AUTO_REMINDER")] == [
+        t.id for t in outbox_rows(app, "NEW_TICKET")[1:4]
+    ]
+
+    # reminder yang sudah terkirim (outbox + WALog) tidak dikirim ulang; hanya #5 yang baru
+    dispatcher.run_once()
+    client.post("/dashboard/queue/next")  # panggil #2 → #3..#5 layak, #3 & #4 sudah
+    reminders = outbox_rows(app, "AUTO_REMINDER")
+    assert len(reminders) == 4
+    assert len({r.queue_id for r in reminders}) == 4
+
+    dispatcher.run_once()
+    assert all(r.status == "sent" for r in outbox_rows(app))
+    assert credits(app, owner) == (10 - 5 - 4, 0)
+
+
+def test_row_status_and_credit_settle_together(app, client, owner, gateway, dispatcher, monkeypatch):
+    take(client, name="A", phone="628111")
+    take(client, name="B", phone="628222")
+    first_id = outbox_rows(app)[0].id
+
+    real_commit = antrifast.credit_commit
+
+    def flaky_commit(umkm_id, descriptions):
+        real_commit(umkm_id, descriptions)
+        if descriptions == ["Konfirmasi tiket #1"]:
+            raise RuntimeError("ledger down")
+
+    monkeypatch.setattr(antrifast, "credit_commit", flaky_commit)
+    assert dispatcher.run_once() == 2
+
+    statuses = {row.id: row.status for row in outbox_rows(app)}
+    assert statuses.pop(first_id) == "sending"  # dibatalkan utuh, diklaim ulang setelah lease habis
+    assert list(statuses.values()) == ["sent"]
+    assert credits(app, owner) == (8, 1)
+    with app.app_context():
+        assert antrifast.WALog.query.count() == 1
+        assert antrifast.CreditLog.query.filter_by(umkm_id=owner, change=-1).count() == 1